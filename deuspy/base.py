@@ -4,3 +4,7 @@ class DeuspyBase:
 
 class DeuspyException(Exception, DeuspyBase):
     pass
+
+
+class DeuspyConflict(DeuspyException):
+    """The document is not at the expected version"""
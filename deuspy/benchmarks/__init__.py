@@ -0,0 +1,75 @@
+"""Benchmarks of the codec, the database and the server.
+
+Every module runs with `python -m deuspy.benchmarks.<module>` and takes
+`--output` to save its results as JSON. `python -m deuspy.benchmarks`
+runs all of them, and `--compare old.json new.json` prints the change
+of every measure between two runs.
+
+"""
+import json
+import platform
+import subprocess
+import time
+from pathlib import Path
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank `fraction` percentile of the sorted
+    `values`"""
+    if not values:
+        return None
+    position = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[position]
+
+
+def revision():
+    """Return the git commit of the working tree or `None`"""
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode('ascii').strip()
+
+
+def save(path, name, results):
+    """Write the `results` of the benchmark `name` to `path` with what
+    is needed to compare them with another run"""
+    out = dict(
+        benchmark=name,
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        revision=revision(),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        results=results,
+    )
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+
+
+def flatten(results, prefix=''):
+    """Yield the dotted path and the value of the numbers of `results`"""
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(old, new):
+    """Return the `(path, old, new, ratio)` of the measures found in both
+    saved runs `old` and `new`"""
+    with open(old) as f:
+        old = dict(flatten(json.load(f)['results']))
+    with open(new) as f:
+        new = dict(flatten(json.load(f)['results']))
+    out = list()
+    for path, before in old.items():
+        after = new.get(path)
+        if after is None:
+            continue
+        ratio = after / before if before else None
+        out.append((path, before, after, ratio))
+    return out
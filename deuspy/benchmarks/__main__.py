@@ -0,0 +1,72 @@
+"""Run every benchmark, or compare two saved runs.
+
+`python -m deuspy.benchmarks --output results.json` saves the results of
+all the benchmarks in a single file, `python -m deuspy.benchmarks
+--compare old.json new.json` prints the measures that changed.
+
+"""
+import argparse
+import asyncio
+import shutil
+import tempfile
+
+from deuspy.benchmarks import compare
+from deuspy.benchmarks import core
+from deuspy.benchmarks import load
+from deuspy.benchmarks import packing
+from deuspy.benchmarks import save
+
+
+def run(sizes, duration):
+    results = dict()
+    print('# packing')
+    results['packing'] = packing.benchmark()
+    packing.report(results['packing'])
+    print('# core')
+    results['core'] = {str(size): core.benchmark(size) for size in sizes}
+    core.report(results['core'])
+    print('# load')
+    path = tempfile.mkdtemp(prefix='deuspy-benchmark-')
+    port = load.free_port()
+    process = load.start_server(path, port)
+    try:
+        url = 'http://127.0.0.1:{}'.format(port)
+        results['load'] = asyncio.run(load.load(url, duration=duration))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(path)
+    load.report(results['load'])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='save the results as JSON in this file')
+    parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in core.SIZES),
+        help='comma separated dataset sizes of the core benchmark (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='seconds of load on the server (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two saved runs instead of running the benchmarks',
+    )
+    args = parser.parse_args()
+    if args.compare:
+        row = '{:<60} {:>14} {:>14} {:>8}'
+        print(row.format('measure', 'old', 'new', 'new/old'))
+        for path, old, new, ratio in compare(*args.compare):
+            ratio = '-' if ratio is None else '{:.2f}'.format(ratio)
+            print(row.format(path, '{:.6g}'.format(old), '{:.6g}'.format(new), ratio))
+        return
+    results = run([int(size) for size in args.sizes.split(',')], args.duration)
+    if args.output:
+        save(args.output, 'all', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Measure the operations of `deuspy.core.Deuspy` on a temporary database.
+
+Run it with `python -m deuspy.benchmarks.core [--sizes 1000,10000]
+[--output FILE]`.
+
+Every dataset size is loaded in a new database, then point operations
+are timed on random documents and queries are timed at several
+selectivities, the fraction of the documents they match.
+
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from deuspy.benchmarks import save
+from deuspy.core import Deuspy
+
+
+SIZES = (1000, 10000, 100000)
+SELECTIVITIES = (0.001, 0.01, 0.1, 0.5)
+# the number of point operations timed per dataset size
+OPERATIONS = 1000
+
+
+def make_doc(i):
+    doc = dict(type='project', title='deuspy-{}'.format(i), rank=i)
+    # `every{n}` is true for one document out of `n`
+    for selectivity in SELECTIVITIES:
+        n = round(1 / selectivity)
+        doc['every{}'.format(n)] = i % n == 0
+    return doc
+
+
+def timed(func, items):
+    """Return the number of operations per second of `func` over every
+    of `items`"""
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def per_query(func, number=5):
+    """Return the best time in milliseconds of `number` calls of `func`
+    and its result"""
+    best = None
+    for _ in range(number):
+        start = time.perf_counter()
+        out = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, out
+
+
+def queries(deuspy, size):
+    """Return the timings of the queries at every selectivity"""
+    out = dict()
+    for selectivity in SELECTIVITIES:
+        n = round(1 / selectivity)
+        equality = {'every{}'.format(n): True}
+        rank = {'rank': {'$lt': int(size * selectivity)}}
+        # two equalities are intersected
+        both = {'type': 'project', 'every{}'.format(n): True}
+        timings = dict()
+        for name, query in (('equality', equality), ('range', rank)):
+            ms, uids = per_query(lambda: list(deuspy.query(**query)))
+            timings[name] = dict(ms=ms, results=len(uids))
+            ms, _ = per_query(lambda: deuspy.page(query, 100))
+            timings[name + '_page'] = dict(ms=ms)
+            # a page from the middle of the results costs the same
+            _, cursor = deuspy.page(query, max(1, len(uids) // 2))
+            ms, _ = per_query(lambda: deuspy.page(query, 100, cursor))
+            timings[name + '_deep_page'] = dict(ms=ms)
+            ms, _ = per_query(lambda: deuspy.count(**query))
+            timings[name + '_count'] = dict(ms=ms)
+        ms, uids = per_query(lambda: list(deuspy.query(**both)))
+        timings['intersection'] = dict(ms=ms, results=len(uids))
+        out[str(selectivity)] = timings
+    return out
+
+
+def benchmark(size, operations=OPERATIONS):
+    """Return the timings of every operation on a database of `size`
+    documents"""
+    path = tempfile.mkdtemp(prefix='deuspy-benchmark-')
+    try:
+        deuspy = Deuspy(path, create_if_missing=True)
+        out = dict()
+        start = time.perf_counter()
+        uids = list(deuspy.create_many(make_doc(i) for i in range(size)))
+        out['create_many'] = size / (time.perf_counter() - start)
+        sample = random.sample(uids, min(operations, size))
+        # query the dataset before it is changed
+        out['query'] = queries(deuspy, size)
+        out['create'] = timed(deuspy.create, [make_doc(size + i) for i in range(operations)])
+        out['read'] = timed(deuspy.read, sample)
+        out['read_json'] = timed(deuspy.read_json, sample)
+        start = time.perf_counter()
+        deuspy.read_many(sample)
+        out['read_many'] = len(sample) / (time.perf_counter() - start)
+        out['update'] = timed(lambda uid: deuspy.update(uid, make_doc(uid)), sample)
+        out['patch'] = timed(lambda uid: deuspy.patch(uid, {'$inc': {'rank': 1}}), sample)
+        out['delete'] = timed(deuspy.delete, sample)
+        deuspy.close()
+        return out
+    finally:
+        shutil.rmtree(path)
+
+
+def report(results):
+    for size, timings in results.items():
+        print('{} documents'.format(size))
+        for name, value in timings.items():
+            if name != 'query':
+                print('  {:<16} {:>12.0f} ops/s'.format(name, value))
+        row = '  {:<12} {:<20} {:>10} {:>10}'
+        print(row.format('selectivity', 'query', 'ms', 'results'))
+        for selectivity, by_query in timings['query'].items():
+            for name, timing in by_query.items():
+                print(row.format(
+                    selectivity, name, '{:.3f}'.format(timing['ms']), timing.get('results', ''),
+                ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in SIZES),
+        help='comma separated dataset sizes (default: %(default)s)',
+    )
+    parser.add_argument('--output', help='save the results as JSON in this file')
+    args = parser.parse_args()
+    results = dict()
+    for size in args.sizes.split(','):
+        results[size] = benchmark(int(size))
+    report(results)
+    if args.output:
+        save(args.output, 'core', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""Measure the latency and the throughput of a deuspy server under load.
+
+Run it with `python -m deuspy.benchmarks.load [--url URL] [--output FILE]`.
+
+Without `--url` a server is started on a temporary database. The
+database is loaded with `--documents` documents, then `--concurrency`
+clients send a mix of reads, updates, creates and queries for
+`--duration` seconds. The latency percentiles and the throughput of
+every kind of request are reported.
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+
+import deuspy
+from deuspy.benchmarks import percentile
+from deuspy.benchmarks import save
+from deuspy.benchmarks.core import make_doc
+
+
+# the weight of every kind of request
+MIX = dict(read=80, update=10, create=5, query=5)
+
+
+async def read(session, url, uids):
+    async with session.get(url + '/' + str(random.choice(uids))) as response:
+        await response.read()
+        return response.status == 200
+
+
+async def update(session, url, uids):
+    uid = random.choice(uids)
+    async with session.post(url + '/' + str(uid), json=make_doc(uid)) as response:
+        await response.read()
+        return response.status == 200
+
+
+async def create(session, url, uids):
+    async with session.post(url + '/', json=make_doc(len(uids))) as response:
+        if response.status != 200:
+            return False
+        uids.append(await response.json())
+        return True
+
+
+async def query(session, url, uids):
+    async with session.get(url + '/', json={'every100': True, '$limit': 10}) as response:
+        await response.read()
+        return response.status == 200
+
+
+OPERATIONS = dict(read=read, update=update, create=create, query=query)
+
+
+async def populate(session, url, documents):
+    """Create `documents` documents with the bulk import and return
+    their uids"""
+    body = ''.join(json.dumps(make_doc(i)) + '\n' for i in range(documents))
+    async with session.post(url + '/_bulk', data=body.encode('utf-8')) as response:
+        lines = (await response.text()).splitlines()
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+async def client(session, url, uids, mix, deadline, latencies, errors):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.perf_counter() < deadline:
+        name = random.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            ok = await OPERATIONS[name](session, url, uids)
+        except aiohttp.ClientError:
+            ok = False
+        latencies[name].append(time.perf_counter() - start)
+        if not ok:
+            errors[name] += 1
+
+
+def summary(latencies, errors, duration):
+    latencies = sorted(latencies)
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        ops_per_second=len(latencies) / duration,
+        p50_ms=percentile(latencies, 0.5) * 1000 if latencies else None,
+        p99_ms=percentile(latencies, 0.99) * 1000 if latencies else None,
+    )
+
+
+async def load(url, documents=10000, concurrency=16, duration=10, mix=MIX):
+    """Return the latency and throughput of every kind of request and of
+    all of them"""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        uids = await populate(session, url, documents)
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        start = time.perf_counter()
+        deadline = start + duration
+        clients = [
+            client(session, url, uids, mix, deadline, latencies, errors)
+            for _ in range(concurrency)
+        ]
+        await asyncio.gather(*clients)
+        elapsed = time.perf_counter() - start
+    out = {name: summary(latencies[name], errors[name], elapsed) for name in mix}
+    everything = [latency for name in mix for latency in latencies[name]]
+    out['total'] = summary(everything, sum(errors.values()), elapsed)
+    return out
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(path, port):
+    """Start a server on a database at `path` and wait until it answers"""
+    # the server runs this deuspy even if it is not installed
+    root = str(Path(deuspy.__file__).parent.parent)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'deuspy.server', '--port', str(port)], cwd=path, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('the server did not start')
+
+
+def report(results):
+    row = '{:<8} {:>10} {:>8} {:>12} {:>10} {:>10}'
+    print(row.format('request', 'requests', 'errors', 'ops/s', 'p50 ms', 'p99 ms'))
+    for name, out in results.items():
+        print(row.format(
+            name, out['requests'], out['errors'], '{:.0f}'.format(out['ops_per_second']),
+            '{:.3f}'.format(out['p50_ms'] or 0), '{:.3f}'.format(out['p99_ms'] or 0),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='url of the server (default: start one)')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--output', help='save the results as JSON in this file')
+    args = parser.parse_args()
+    path = process = None
+    url = args.url
+    if url is None:
+        path = tempfile.mkdtemp(prefix='deuspy-benchmark-')
+        port = free_port()
+        process = start_server(path, port)
+        url = 'http://127.0.0.1:{}'.format(port)
+    try:
+        url = url.rstrip('/')
+        results = asyncio.run(load(url, args.documents, args.concurrency, args.duration))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(path)
+    report(results)
+    if args.output:
+        save(args.output, 'load', results)
+
+
+if __name__ == '__main__':
+    main()
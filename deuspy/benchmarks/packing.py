@@ -0,0 +1,85 @@
+"""Compare pack and unpack with the reference _encode and _decode codec.
+
+Run it with `python -m deuspy.benchmarks.packing [--output FILE]`.
+
+"""
+import argparse
+import timeit
+
+from deuspy import packing
+from deuspy.benchmarks import save
+
+
+VALUES = dict(
+    ints=[(-1 << 40) + i * 7919 for i in range(1000)],
+    strings=['deuspy-{}'.format(i) for i in range(1000)],
+    floats=[(i - 500) * 3.14159 for i in range(1000)],
+    blobs=[b'blob-%d' % i for i in range(1000)],
+    nested=[('type', ('project', i, -i * 0.5), [None, True, b'blob']) for i in range(1000)],
+    index=[('title', 'deuspy-{}'.format(i), i) for i in range(1000)],
+)
+
+
+def reference_pack(t, prefix=None):
+    return packing._pack_maybe_with_versionstamp(t, prefix)[0]
+
+
+def reference_unpack(key, prefix_len=0):
+    pos = prefix_len
+    res = []
+    while pos < len(key):
+        r, pos = packing._decode(key, pos)
+        res.append(r)
+    return tuple(res)
+
+
+def measure(func, items, number):
+    """Return the average time in seconds to call `func` on every of `items`"""
+    def run():
+        for item in items:
+            func(item)
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def benchmark(number=20):
+    """Return the timings of both codecs by kind of values"""
+    out = dict()
+    for name, values in VALUES.items():
+        tuples = [value if isinstance(value, tuple) else (value,) for value in values]
+        keys = packing.pack_many(tuples)
+        out[name] = dict(
+            pack=measure(packing.pack, tuples, number),
+            reference_pack=measure(reference_pack, tuples, number),
+            unpack=measure(packing.unpack, keys, number),
+            reference_unpack=measure(reference_unpack, keys, number),
+        )
+    return out
+
+
+def report(results):
+    row = '{:<16} {:>12} {:>12} {:>8}'
+    print(row.format('values', 'reference', 'fast', 'speedup'))
+    for name, timings in results.items():
+        for operation in ('pack', 'unpack'):
+            reference = timings['reference_' + operation]
+            fast = timings[operation]
+            print(row.format(
+                name + ' ' + operation,
+                '{:.2f}ms'.format(reference * 1000),
+                '{:.2f}ms'.format(fast * 1000),
+                '{:.1f}x'.format(reference / fast),
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='save the results as JSON in this file')
+    args = parser.parse_args()
+    results = benchmark()
+    report(results)
+    if args.output:
+        save(args.output, 'packing', results)
+
+
+if __name__ == '__main__':
+    main()
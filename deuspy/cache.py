@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+def copy(value):
+    """Copy the dicts and lists of a decoded document"""
+    if isinstance(value, dict):
+        return {key: copy(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [copy(item) for item in value]
+    else:
+        return value
+
+
+class LRU:
+    """Least recently used cache bounded by a number of `entries` and/or
+    a total `size` in bytes.
+
+    Values are not copied, it is up to the caller to not mutate them.
+
+    """
+
+    def __init__(self, entries=None, size=None):
+        self.entries = entries
+        self.size = size
+        self._values = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        # bumped on every invalidation, see `set`
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size, version):
+        """Cache `value` of `size` bytes unless something was invalidated
+        since `version` was taken, in which case `value` might be stale"""
+        with self._lock:
+            if version != self._version:
+                return
+            if self.size is not None and size > self.size:
+                return
+            self._pop(key)
+            self._values[key] = (value, size)
+            self._bytes += size
+            while ((self.entries is not None and len(self._values) > self.entries)
+                   or (self.size is not None and self._bytes > self.size)):
+                _, (_, size) = self._values.popitem(last=False)
+                self._bytes -= size
+
+    def _pop(self, key):
+        try:
+            _, size = self._values.pop(key)
+        except KeyError:
+            pass
+        else:
+            self._bytes -= size
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self._pop(key)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self._values),
+            bytes=self._bytes,
+        )
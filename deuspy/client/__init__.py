@@ -0,0 +1,293 @@
+"""Asynchronous client, see `deuspy.client.sync` for the synchronous
+client"""
+import asyncio
+import json
+from urllib.parse import quote
+
+import aiohttp
+
+from deuspy.base import DeuspyBase
+from deuspy.base import DeuspyConflict
+from deuspy.base import DeuspyException
+from deuspy.cache import LRU
+from deuspy.cache import copy
+
+
+async def response_to_exception(response):
+    reason = await response.text()
+    msg = '{} ({})'.format(reason, response.status)
+    if response.status == 412:
+        raise DeuspyConflict(msg)
+    raise DeuspyException(msg)
+
+
+def if_match(etag):
+    return dict() if etag is None else {'If-Match': etag}
+
+
+class Deuspy(DeuspyBase):
+
+    def __init__(self, session, host, port, cache_entries=None, cache_size=None):
+        """Use the `aiohttp.ClientSession` `session` to talk to the server
+        at `host` and `port`, see `connect`.
+
+        Documents read are cached when `cache_entries` (a number of
+        documents) and/or `cache_size` (a number of bytes) are given,
+        the server is still asked whether they changed on every read
+        but does not send them again when they did not.
+
+        """
+        self._session = session
+        self._domain = host + ':' + str(port)
+        if cache_entries is None and cache_size is None:
+            self._cache = None
+        else:
+            self._cache = LRU(cache_entries, cache_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def create(self, doc):
+        async with self._session.post(self._domain, json=doc) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def create_many(self, docs):
+        """Stream the documents of the iterable `docs` to the server and
+        yield the uid of every document or the `DeuspyException` that
+        prevented its creation"""
+        async def body():
+            for doc in docs:
+                yield (json.dumps(doc) + '\n').encode('utf-8')
+
+        url = self._domain + '/_bulk'
+        headers = {'Content-Type': 'application/x-ndjson'}
+        async with self._session.post(url, data=body(), headers=headers) as response:
+            if response.status != 200:
+                await response_to_exception(response)
+            async for line in response.content:
+                if line.strip():
+                    result = json.loads(line)
+                    if isinstance(result, dict):
+                        yield DeuspyException(result['error'])
+                    else:
+                        yield result
+
+    async def read(self, uid):
+        doc, _ = await self.read_versioned(uid)
+        return doc
+
+    async def read_versioned(self, uid):
+        """Return the document associated with `uid` and its ETag, that
+        can be passed to `update`, `patch` and `delete` so that they fail
+        with `DeuspyConflict` if the document changed meanwhile"""
+        url = self._domain + '/' + str(uid)
+        headers = dict()
+        if self._cache is not None:
+            version = self._cache.version()
+            cached = self._cache.get(uid)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+        async with self._session.get(url, headers=headers) as response:
+            if response.status == 304:
+                etag, doc = cached
+                return copy(doc), etag
+            if response.status != 200:
+                if self._cache is not None:
+                    self._cache.invalidate(uid)
+                await response_to_exception(response)
+            body = await response.read()
+            etag = response.headers.get('ETag')
+        doc = json.loads(body)
+        if self._cache is not None and etag is not None:
+            self._cache.set(uid, (etag, copy(doc)), len(body), version)
+        return doc, etag
+
+    def _invalidate(self, uid):
+        if self._cache is not None:
+            self._cache.invalidate(uid)
+
+    async def read_many(self, uids):
+        """Return a dict mapping the uid of the existing documents among
+        `uids` to the document, in a single request"""
+        url = self._domain + '/_mget'
+        async with self._session.post(url, json=list(uids)) as response:
+            if response.status == 200:
+                docs = await response.json()
+                return {int(uid): doc for uid, doc in docs.items()}
+            else:
+                await response_to_exception(response)
+
+    async def update(self, uid, doc, etag=None):
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        async with self._session.post(url, json=doc, headers=if_match(etag)) as response:
+            if response.status != 200:
+                await response_to_exception(response)
+
+    async def update_many(self, docs):
+        """Update the documents of the dict `docs` mapping uids to their
+        new document with concurrent requests, return the list of `None`
+        or the `DeuspyException` of every update"""
+        updates = (self.update(uid, doc) for uid, doc in docs.items())
+        return await asyncio.gather(*updates, return_exceptions=True)
+
+    async def patch(self, uid, operations, etag=None):
+        """Apply the `$set`, `$unset` and `$inc` `operations` to the
+        document associated with `uid` on the server and return the new
+        document"""
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        headers = if_match(etag)
+        async with self._session.patch(url, json=operations, headers=headers) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def delete(self, uid, etag=None):
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        async with self._session.delete(url, headers=if_match(etag)) as response:
+            if response.status != 200:
+                await response_to_exception(response)
+
+    async def delete_many(self, uids):
+        """Delete the documents of `uids` with concurrent requests, return
+        the list of `None` or the `DeuspyException` of every delete"""
+        deletes = (self.delete(uid) for uid in uids)
+        return await asyncio.gather(*deletes, return_exceptions=True)
+
+    async def query(self, **kwargs):
+        async with self._session.get(self._domain, json=kwargs) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def count(self, **kwargs):
+        """Return the number of documents matching `kwargs`"""
+        url = self._domain + '/_count'
+        async with self._session.get(url, json=kwargs) as response:
+            if response.status == 200:
+                out = await response.json()
+                return out['count']
+            else:
+                await response_to_exception(response)
+
+    async def distinct(self, key):
+        """Return the sorted list of the values of `key`"""
+        url = self._domain + '/_distinct/' + quote(key, safe='')
+        async with self._session.get(url) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def group_by(self, key):
+        """Return the values of `key` and their number of documents, as
+        `[value, count]` pairs"""
+        url = self._domain + '/_group/' + quote(key, safe='')
+        async with self._session.get(url) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def stream(self, **kwargs):
+        """Iterate over the `(uid, doc)` matching `kwargs` as the server
+        produces them"""
+        headers = dict(Accept='application/x-ndjson')
+        async with self._session.get(self._domain, json=kwargs, headers=headers) as response:
+            if response.status != 200:
+                await response_to_exception(response)
+            async for line in response.content:
+                if line.strip():
+                    uid, doc = json.loads(line)
+                    yield uid, doc
+
+    async def paginate(self, query=None, limit=100):
+        """Iterate over the `(uid, doc)` matching the `query` dict, fetching
+        `limit` documents at a time as the iteration goes"""
+        query = dict(query or dict())
+        query['$limit'] = limit
+        headers = dict(Accept='application/x-ndjson')
+        while True:
+            async with self._session.get(self._domain, json=query, headers=headers) as response:
+                if response.status != 200:
+                    await response_to_exception(response)
+                async for line in response.content:
+                    if line.strip():
+                        uid, doc = json.loads(line)
+                        yield uid, doc
+                cursor = response.headers.get('Deuspy-Cursor')
+            if cursor is None:
+                break
+            query['$cursor'] = cursor
+
+    async def changes(self, since=None, timeout=None):
+        """Return the `[sequence, operation, uid]` of the changes after
+        `since` and the `since` of the next call, waiting at most
+        `timeout` seconds for one"""
+        params = dict()
+        if since is not None:
+            params['since'] = str(since)
+        if timeout is not None:
+            params['timeout'] = str(timeout)
+        url = self._domain + '/_changes'
+        async with self._session.get(url, params=params) as response:
+            if response.status == 200:
+                out = await response.json()
+                return out['changes'], out['last']
+            else:
+                await response_to_exception(response)
+
+    async def indexes(self):
+        """Return the index configuration of the server"""
+        url = self._domain + '/_indexes'
+        async with self._session.get(url) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def configure(self, fields=None, covering=None):
+        """Index only `fields`, or every field when it is `None`, with
+        the `covering` indexes, the index is built in the background"""
+        url = self._domain + '/_indexes'
+        config = dict(fields=fields, covering=covering)
+        async with self._session.put(url, json=config) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                await response_to_exception(response)
+
+    async def close(self):
+        await self._session.close()
+
+
+async def connect(
+        host='http://localhost', port=9990, limit=100, limit_per_host=0, keepalive=30,
+        timeout=None, connect_timeout=None, cache_entries=None, cache_size=None
+):
+    """Return a client with its own pool of at most `limit` connections,
+    `limit_per_host` to a single host when it is not zero, that are kept
+    alive `keepalive` seconds once idle.
+
+    Requests fail after `timeout` seconds and their connection after
+    `connect_timeout` seconds, no timeout when they are `None`. See
+    `Deuspy` for `cache_entries` and `cache_size`.
+
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive
+    )
+    timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+    session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    deuspy = Deuspy(session, host, port, cache_entries, cache_size)
+    return deuspy
@@ -0,0 +1,250 @@
+"""Synchronous client, based on a `requests.Session` that keeps its
+connections alive"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from deuspy.base import DeuspyBase
+from deuspy.base import DeuspyConflict
+from deuspy.base import DeuspyException
+from deuspy.cache import LRU
+from deuspy.cache import copy
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def response_to_exception(response):
+    msg = '{} ({})'.format(response.text, response.status_code)
+    if response.status_code == 412:
+        raise DeuspyConflict(msg)
+    raise DeuspyException(msg)
+
+
+def if_match(etag):
+    return dict() if etag is None else {'If-Match': etag}
+
+
+class Deuspy(DeuspyBase):
+
+    def __init__(
+            self, host='http://localhost', port=9990, pool=10, timeout=None,
+            connect_timeout=None, cache_entries=None, cache_size=None
+    ):
+        """Talk to the server at `host` and `port` over at most `pool`
+        connections kept alive between requests.
+
+        Requests fail after `timeout` seconds without an answer and their
+        connection after `connect_timeout` seconds, no timeout when they
+        are `None`.
+
+        Documents read are cached when `cache_entries` (a number of
+        documents) and/or `cache_size` (a number of bytes) are given,
+        the server is still asked whether they changed on every read
+        but does not send them again when they did not.
+
+        """
+        self._domain = host + ':' + str(port)
+        self._pool = pool
+        self._timeout = (connect_timeout, timeout)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if cache_entries is None and cache_size is None:
+            self._cache = None
+        else:
+            self._cache = LRU(cache_entries, cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, method, url, **kwargs):
+        response = self._session.request(method, url, timeout=self._timeout, **kwargs)
+        if response.status_code != 200:
+            response_to_exception(response)
+        return response
+
+    def _many(self, func, items):
+        """Call `func` with every of `items` over concurrent connections,
+        return the list of results or the `DeuspyException` raised"""
+        def call(args):
+            try:
+                return func(*args)
+            except DeuspyException as exc:
+                return exc
+
+        with ThreadPoolExecutor(max_workers=self._pool) as executor:
+            return list(executor.map(call, items))
+
+    def create(self, doc):
+        return self._request('POST', self._domain, json=doc).json()
+
+    def create_many(self, docs):
+        """Stream the documents of the iterable `docs` to the server and
+        yield the uid of every document or the `DeuspyException` that
+        prevented its creation"""
+        def body():
+            for doc in docs:
+                yield (json.dumps(doc) + '\n').encode('utf-8')
+
+        url = self._domain + '/_bulk'
+        headers = {'Content-Type': NDJSON}
+        response = self._request('POST', url, data=body(), headers=headers, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if line.strip():
+                    result = json.loads(line)
+                    if isinstance(result, dict):
+                        yield DeuspyException(result['error'])
+                    else:
+                        yield result
+
+    def read(self, uid):
+        doc, _ = self.read_versioned(uid)
+        return doc
+
+    def read_versioned(self, uid):
+        """Return the document associated with `uid` and its ETag, that
+        can be passed to `update`, `patch` and `delete` so that they fail
+        with `DeuspyConflict` if the document changed meanwhile"""
+        url = self._domain + '/' + str(uid)
+        headers = dict()
+        if self._cache is not None:
+            version = self._cache.version()
+            cached = self._cache.get(uid)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+        response = self._session.get(url, headers=headers, timeout=self._timeout)
+        if response.status_code == 304:
+            etag, doc = cached
+            return copy(doc), etag
+        if response.status_code != 200:
+            self._invalidate(uid)
+            response_to_exception(response)
+        doc = response.json()
+        etag = response.headers.get('ETag')
+        if self._cache is not None and etag is not None:
+            self._cache.set(uid, (etag, copy(doc)), len(response.content), version)
+        return doc, etag
+
+    def _invalidate(self, uid):
+        if self._cache is not None:
+            self._cache.invalidate(uid)
+
+    def read_many(self, uids):
+        """Return a dict mapping the uid of the existing documents among
+        `uids` to the document, in a single request"""
+        url = self._domain + '/_mget'
+        docs = self._request('POST', url, json=list(uids)).json()
+        return {int(uid): doc for uid, doc in docs.items()}
+
+    def update(self, uid, doc, etag=None):
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        self._request('POST', url, json=doc, headers=if_match(etag))
+
+    def update_many(self, docs):
+        """Update the documents of the dict `docs` mapping uids to their
+        new document with concurrent requests, return the list of `None`
+        or the `DeuspyException` of every update"""
+        return self._many(self.update, docs.items())
+
+    def patch(self, uid, operations, etag=None):
+        """Apply the `$set`, `$unset` and `$inc` `operations` to the
+        document associated with `uid` on the server and return the new
+        document"""
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        return self._request('PATCH', url, json=operations, headers=if_match(etag)).json()
+
+    def delete(self, uid, etag=None):
+        url = self._domain + '/' + str(uid)
+        self._invalidate(uid)
+        self._request('DELETE', url, headers=if_match(etag))
+
+    def delete_many(self, uids):
+        """Delete the documents of `uids` with concurrent requests, return
+        the list of `None` or the `DeuspyException` of every delete"""
+        return self._many(self.delete, ((uid,) for uid in uids))
+
+    def query(self, **kwargs):
+        return self._request('GET', self._domain, json=kwargs).json()
+
+    def count(self, **kwargs):
+        """Return the number of documents matching `kwargs`"""
+        url = self._domain + '/_count'
+        return self._request('GET', url, json=kwargs).json()['count']
+
+    def distinct(self, key):
+        """Return the sorted list of the values of `key`"""
+        url = self._domain + '/_distinct/' + quote(key, safe='')
+        return self._request('GET', url).json()
+
+    def group_by(self, key):
+        """Return the values of `key` and their number of documents, as
+        `[value, count]` pairs"""
+        url = self._domain + '/_group/' + quote(key, safe='')
+        return self._request('GET', url).json()
+
+    def stream(self, **kwargs):
+        """Iterate over the `(uid, doc)` matching `kwargs` as the server
+        produces them"""
+        headers = dict(Accept=NDJSON)
+        response = self._request('GET', self._domain, json=kwargs, headers=headers, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if line.strip():
+                    uid, doc = json.loads(line)
+                    yield uid, doc
+
+    def paginate(self, query=None, limit=100):
+        """Iterate over the `(uid, doc)` matching the `query` dict, fetching
+        `limit` documents at a time as the iteration goes"""
+        query = dict(query or dict())
+        query['$limit'] = limit
+        headers = dict(Accept=NDJSON)
+        while True:
+            response = self._request('GET', self._domain, json=query, headers=headers)
+            for line in response.iter_lines():
+                if line.strip():
+                    uid, doc = json.loads(line)
+                    yield uid, doc
+            cursor = response.headers.get('Deuspy-Cursor')
+            if cursor is None:
+                break
+            query['$cursor'] = cursor
+
+    def changes(self, since=None, timeout=None):
+        """Return the `[sequence, operation, uid]` of the changes after
+        `since` and the `since` of the next call, waiting at most
+        `timeout` seconds for one"""
+        params = dict()
+        if since is not None:
+            params['since'] = str(since)
+        if timeout is not None:
+            params['timeout'] = str(timeout)
+        url = self._domain + '/_changes'
+        out = self._request('GET', url, params=params).json()
+        return out['changes'], out['last']
+
+    def indexes(self):
+        """Return the index configuration of the server"""
+        url = self._domain + '/_indexes'
+        return self._request('GET', url).json()
+
+    def configure(self, fields=None, covering=None):
+        """Index only `fields`, or every field when it is `None`, with
+        the `covering` indexes, the index is built in the background"""
+        url = self._domain + '/_indexes'
+        config = dict(fields=fields, covering=covering)
+        return self._request('PUT', url, json=config).json()
+
+    def close(self):
+        self._session.close()
@@ -1,98 +1,1115 @@
 import json
 import sys
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import Counter
+from itertools import chain
+from itertools import islice
 from random import randint
+from threading import Lock
+from time import perf_counter
 
+import daiquiri
+
+from deuspy import document
 from deuspy.base import DeuspyBase
+from deuspy.base import DeuspyConflict
+from deuspy.base import DeuspyException
+from deuspy.cache import LRU
+from deuspy.cache import copy
+from deuspy.metrics import Metrics
+from deuspy.metrics import timed
 from deuspy.packing import pack
+from deuspy.packing import skip
 from deuspy.packing import unpack
+from deuspy.packing import unpack_at
+from deuspy.predicate import Predicate
 
 from plyvel import DB
 
 
-def random():
-    return randint(0, sys.maxsize)
+log = daiquiri.getLogger(__name__)
+
+DOCS = b'docs:'
+INDEX = b'index:'
+STATS = b'stats:'
+# the change log maps a sequence number to the operation and the uid
+CHANGES = b'changes:'
+# the version of a document is the sequence number of its last change
+VERSIONS = b'versions:'
+META_STATS = b'meta:stats'
+META_COUNT = b'meta:count'
+META_UID = b'meta:uid'
+# the index configuration being built and the one completely built
+META_INDEXES = b'meta:indexes'
+META_INDEXES_BUILT = b'meta:indexes:built'
+# the biggest uid whose index entries follow META_INDEXES
+META_BACKFILL = b'meta:backfill'
+
+# index every field, without covering values
+DEFAULT_INDEXES = dict(fields=None, covering=dict())
+
+# the type of the operand of every patch operator
+PATCH_OPERATORS = {'$set': dict, '$unset': list, '$inc': dict}
+
+# read_many switches from point gets to a single iterator at this number
+# of uids
+READ_MANY_SEEK = 32
+
+# the counters of `Deuspy.metrics`
+COUNTERS = dict(
+    index_keys_scanned='Index keys read by range scans and intersections',
+    document_keys_scanned='Document keys read by scans of every document',
+    point_gets='Keys read one at a time',
+    seeks='Document keys read by seeking a single iterator',
+    documents_decoded='Stored documents decoded',
+    bytes_written='Bytes of the keys and values written',
+)
+
+
+def random(shards=1, shard=0):
+    """Return a random uid congruent to `shard` modulo `shards`"""
+    return randint(0, sys.maxsize // shards - 1) * shards + shard
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _indexed(config, key):
+    return config['fields'] is None or key in config['fields']
+
+
+def _index_entries(config, doc, uid):
+    """Return the index entries of `doc` according to `config`, a dict
+    mapping the index key to the indexed `(key, value)` and the value of
+    the index entry, which holds the projection of covering indexes"""
+    out = dict()
+    for key, value in doc.items():
+        if isinstance(value, dict) or not _indexed(config, key):
+            continue  # dicts can not be packed
+        try:
+            index = pack((key, value, uid), prefix=INDEX)
+        except ValueError:
+            continue  # neither lists holding dicts
+        projection = config['covering'].get(key)
+        if projection is None:
+            entry = b''
+        else:
+            entry = {field: doc[field] for field in projection if field in doc}
+            entry = document.dumps(entry)
+        out[index] = ((key, value), entry)
+    return out
+
+
+class Batch:
+    """A write batch that sees its own writes"""
+
+    def __init__(self, db, sync=False, metrics=None):
+        self._db = db
+        self._batch = db.write_batch(sync=sync)
+        self._pending = dict()
+        self._metrics = metrics
+        self._gets = 0
+        self._bytes = 0
+        # uids of the documents written by the batch
+        self.uids = set()
+
+    def get(self, key):
+        try:
+            return self._pending[key]
+        except KeyError:
+            self._gets += 1
+            return self._db.get(key)
+
+    def put(self, key, value):
+        self._pending[key] = value
+        self._batch.put(key, value)
+        self._bytes += len(key) + len(value)
+
+    def delete(self, key):
+        self._pending[key] = None
+        self._batch.delete(key)
+        self._bytes += len(key)
+
+    def write(self):
+        if self._pending:
+            self._batch.write()
+        if self._metrics is not None:
+            self._metrics.merge(dict(point_gets=self._gets, bytes_written=self._bytes))
 
 
 class Deuspy(DeuspyBase):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+            self, *args, cache_entries=None, cache_size=None, uids='sequential',
+            uid_block=1024, format='binary', shard=0, shards=1, slow_query=None, **kwargs
+    ):
+        """Open the database, the arguments are those of `plyvel.DB`.
+
+        Decoded documents and their JSON encoding are cached when
+        `cache_entries` (a number of entries) and/or `cache_size` (a
+        number of bytes) are given.
+
+        New documents get increasing uids when `uids` is `sequential`,
+        reserved `uid_block` at a time, or unguessable uids when it is
+        `random`. The uids are congruent to `shard` modulo `shards` so
+        that the shard owning a uid is known, see `deuspy.router`.
+
+        Documents are written in `format`, `binary` or `json`, and read
+        whatever their format, see `deuspy.document` and `migrate`.
+
+        Queries that take more than `slow_query` seconds are logged with
+        their scan statistics, see `metrics`.
+
+        """
+        if uids not in ('sequential', 'random'):
+            raise DeuspyException('Unknown uids mode {!r}'.format(uids))
+        if not 0 <= shard < shards:
+            raise DeuspyException('Shard {} out of {} shards'.format(shard, shards))
+        if format not in document.FORMATS:
+            raise DeuspyException('Unknown document format {!r}'.format(format))
+        self._format = format
+        self._slow_query = slow_query
+        self._metrics = Metrics('deuspy_', 'operation', COUNTERS)
         self._db = DB(*args, **kwargs)
-        self._docs = self._db.prefixed_db(b'docs:')
-        self._index = self._db.prefixed_db(b'index:')
+        if cache_entries is None and cache_size is None:
+            self._cache = None
+        else:
+            self._cache = LRU(cache_entries, cache_size)
+        self._docs = self._db.prefixed_db(DOCS)
+        self._index = self._db.prefixed_db(INDEX)
+        self._stats = self._db.prefixed_db(STATS)
+        self._changes = self._db.prefixed_db(CHANGES)
+        # writes read the previous state of the database to maintain the
+        # index and the statistics, they must not interleave
+        self._lock = Lock()
+        self._indexes = self._load_config(META_INDEXES)
+        self._built = self._load_config(META_INDEXES_BUILT)
+        value = self._db.get(META_BACKFILL)
+        self._backfill = None if value is None else unpack(value)[0]
+        if self._db.get(META_STATS) is None:
+            self._rebuild_stats()
+        self._random = uids == 'random'
+        self._uid_block = uid_block
+        self._shard = shard
+        self._shards = shards
+        # start after the reserved uids and the biggest uid in use, in
+        # case the database was written in random mode meanwhile, both
+        # counted in blocks of `shards` uids
+        self._next_uid = max(1, self._counter(META_UID))
+        for key in self._docs.iterator(reverse=True, include_value=False):
+            self._next_uid = max(self._next_uid, unpack(key)[0] // shards + 1)
+            break
+        self._reserved_uid = self._next_uid
+        # the sequence number of the last change
+        self._sequence = 0
+        for key in self._changes.iterator(reverse=True, include_value=False):
+            self._sequence = unpack(key)[0]
+            break
+        # called with the last sequence number after every write
+        self._listeners = list()
 
-    def _save(self, doc, uid):
-        # store the doc as json
-        key = pack((uid,))
-        value = json.dumps(doc).encode('utf-8')
-        self._docs.put(key, value)
-        # index it
-        for key, value in doc.items():
-            index = pack((key, value, uid))
-            self._index.put(index, b'')
-        # done!
+    def close(self):
+        self._db.close()
 
-    def create(self, doc):
-        """Store `doc` and return it's unique identifier"""
-        # make a unique random identifier
+    def metrics(self):
+        """Return the `deuspy.metrics.Metrics` of the database: the
+        latency of every operation and the number of keys read, documents
+        decoded and bytes written"""
+        return self._metrics
+
+    def _load_config(self, key):
+        value = self._db.get(key)
+        return DEFAULT_INDEXES if value is None else json.loads(value.decode('utf-8'))
+
+    def indexes(self):
+        """Return the index configuration and whether it is completely
+        built"""
+        return dict(self._indexes, built=self._backfill is None)
+
+    def configure(self, fields=None, covering=None):
+        """Change the index configuration, `backfill` must be called to
+        build the index of the new configuration.
+
+        Only the top-level `fields` are indexed, or every field when it
+        is `None`. `covering` maps indexed fields to a list of fields
+        stored in their index entries, so that `select` can answer from
+        the index without reading the documents.
+
+        """
+        config = dict(fields=fields, covering=covering or dict())
+        if fields is not None and not all(isinstance(field, str) for field in fields):
+            raise DeuspyException('Indexed fields must be strings')
+        for key, projection in config['covering'].items():
+            if not isinstance(projection, (list, tuple)) or not all(
+                    isinstance(field, str) for field in projection
+            ):
+                msg = 'Covering index on {!r} must list the names of its fields'.format(key)
+                raise DeuspyException(msg)
+            if not _indexed(config, key):
+                raise DeuspyException('Covering index on {!r} is not indexed'.format(key))
+        with self._lock:
+            if self._backfill is not None:
+                raise DeuspyException('The index is being built, try again later')
+            if config == self._indexes:
+                return
+            with self._db.write_batch(transaction=True) as batch:
+                batch.put(META_INDEXES, json.dumps(config).encode('utf-8'))
+                batch.put(META_BACKFILL, pack((-1,)))
+            self._indexes = config
+            self._backfill = -1
+
+    def _index_entries(self, doc, uid):
+        # the documents not backfilled yet follow the built configuration
+        if self._backfill is None or uid <= self._backfill:
+            return _index_entries(self._indexes, doc, uid)
+        else:
+            return _index_entries(self._built, doc, uid)
+
+    def _ready(self, key):
+        """Return whether the index of `key` is complete"""
+        return _indexed(self._indexes, key) and _indexed(self._built, key)
+
+    def _covering(self, key):
+        """Return the fields stored in the complete covering index of
+        `key` or `None`"""
+        projection = self._indexes['covering'].get(key)
+        if projection is None or projection != self._built['covering'].get(key):
+            return None
+        return projection
+
+    def backfill(self, size=1000):
+        """Build the index of the configuration set with `configure`,
+        `size` documents at a time so that it can run while the database
+        is in use. Return the number of documents indexed."""
+        count = 0
         while True:
-            uid = random()
-            if self.read(uid) is None:
-                break
+            with self._lock:
+                if self._backfill is None:
+                    return count
+                batch = Batch(self._db, metrics=self._metrics)
+                start = pack((self._backfill + 1,))
+                iterator = self._docs.iterator(start=start)
+                uid = None
+                for key, value in islice(iterator, size):
+                    uid = unpack_at(key, 0)[0]
+                    doc = self._load(value)
+                    old = _index_entries(self._built, doc, uid)
+                    new = _index_entries(self._indexes, doc, uid)
+                    self._reindex(batch, old, new)
+                    count += 1
+                if uid is None:
+                    # done!
+                    batch.put(META_INDEXES_BUILT, self._db.get(META_INDEXES))
+                    batch.delete(META_BACKFILL)
+                    batch.write()
+                    self._built = self._indexes
+                    self._backfill = None
+                else:
+                    batch.put(META_BACKFILL, pack((uid,)))
+                    batch.write()
+                    self._backfill = uid
 
-        self._save(doc, uid)
+    def _rebuild_stats(self):
+        """Recompute the per-(field, value) counters from the index"""
+        counter = Counter()
+        for index in self._index.iterator(include_value=False):
+            key, value, _ = unpack(index)
+            counter[pack((key, value), prefix=STATS)] += 1
+        count = sum(1 for _ in self._docs.iterator(include_value=False))
+        with self._db.write_batch(transaction=True) as batch:
+            for stat in self._stats.iterator(include_value=False):
+                batch.delete(STATS + stat)
+            for stat, value in counter.items():
+                batch.put(stat, pack((value,)))
+            batch.put(META_COUNT, pack((count,)))
+            batch.put(META_STATS, b'')
 
-        return uid
+    def _counter(self, key, source=None):
+        value = (source or self._db).get(key)
+        return 0 if value is None else unpack(value)[0]
 
-    def read(self, uid):
-        """Retrieve the doc associated with `uid`"""
-        key = pack((uid,))
-        value = self._docs.get(key)
+    def _increment(self, batch, key, delta):
+        count = self._counter(key, batch) + delta
+        if count:
+            batch.put(key, pack((count,)))
+        else:
+            batch.delete(key)
+
+    def _reindex(self, batch, old, new):
+        """Write the difference between the `old` and `new` index entries"""
+        for index in old.keys() - new.keys():
+            batch.delete(index)
+            self._increment(batch, pack(old[index][0], prefix=STATS), -1)
+        for index, (item, entry) in new.items():
+            previous = old.get(index)
+            if previous is None:
+                batch.put(index, entry)
+                self._increment(batch, pack(item, prefix=STATS), 1)
+            elif previous[1] != entry:
+                # a covered field changed
+                batch.put(index, entry)
+
+    def _save(self, batch, uid, doc, old=None):
+        # pack the index keys first, so that an unsupported value
+        # fails before anything is written
+        new = self._index_entries(doc, uid)
+        old = self._index_entries(old, uid) if old else dict()
+        # store the doc
+        key = pack((uid,), prefix=DOCS)
+        value = document.dumps(doc, self._format)
+        if batch.get(key) is None:
+            self._increment(batch, META_COUNT, 1)
+        batch.put(key, value)
+        batch.uids.add(uid)
+        # only touch the index keys that changed
+        self._reindex(batch, old, new)
+        # done!
+
+    def _load(self, value):
         if value is None:
             return None
         else:
-            value = value.decode('utf-8')
-            doc = json.loads(value)
-            return doc
+            self._metrics.add('documents_decoded')
+            return document.loads(value)
+
+    def migrate(self, size=1000):
+        """Rewrite the documents stored in another format than the one
+        of the database, `size` documents at a time so that it can run
+        while the database is in use. Return the number of documents
+        rewritten."""
+        count = 0
+        iterator = self._docs.iterator()
+        while True:
+            chunk = list(islice(iterator, size))
+            if not chunk:
+                return count
+            keys = [
+                DOCS + key for key, value in chunk if document.format_of(value) != self._format
+            ]
+            with self._lock:
+                batch = Batch(self._db, metrics=self._metrics)
+                for key in keys:
+                    # the document may have changed since it was scanned
+                    value = batch.get(key)
+                    if value is not None and document.format_of(value) != self._format:
+                        batch.put(key, document.dumps(self._load(value), self._format))
+                        count += 1
+                batch.write()
+
+    def _allocate(self):
+        if self._next_uid == self._reserved_uid:
+            # persist the end of the next block before handing out any
+            # of its uids, after a crash the rest of the block is skipped
+            self._reserved_uid = self._next_uid + self._uid_block
+            self._db.put(META_UID, pack((self._reserved_uid,)), sync=True)
+        uid = self._next_uid * self._shards + self._shard
+        self._next_uid += 1
+        return uid
+
+    def _create(self, batch, doc):
+        if self._random:
+            # make a unique random identifier
+            while True:
+                uid = random(self._shards, self._shard)
+                if batch.get(pack((uid,), prefix=DOCS)) is None:
+                    break
+        else:
+            uid = self._allocate()
+        self._save(batch, uid, doc)
+        self._log(batch, 'create', uid)
+        return uid
 
-    def delete(self, uid):
-        """Delete the document associated with `uid`"""
-        doc = self.read(uid)
+    def _version(self, source, uid):
+        """Return the version of the document `uid` or `None` if it does
+        not exist, documents written before versions have version 0"""
+        if source.get(pack((uid,), prefix=DOCS)) is None:
+            return None
+        return self._counter(pack((uid,), prefix=VERSIONS), source)
+
+    def _check(self, batch, uid, version):
+        """Raise `DeuspyConflict` unless `version` is `None` or the version
+        of the document `uid`"""
+        if version is None:
+            return
+        current = self._version(batch, uid)
+        if current != version:
+            msg = 'Document {} is at version {}, not {}'.format(uid, current, version)
+            raise DeuspyConflict(msg)
+
+    def _update(self, batch, uid, doc, version=None):
+        self._check(batch, uid, version)
+        old = self._load(batch.get(pack((uid,), prefix=DOCS)))
+        self._save(batch, uid, doc, old)
+        self._log(batch, 'update', uid)
+
+    def _patch(self, batch, uid, operations, version=None):
+        self._check(batch, uid, version)
+        old = self._load(batch.get(pack((uid,), prefix=DOCS)))
+        if old is None:
+            return None
+        doc = dict(old)
+        for operator, operand in operations.items():
+            expected = PATCH_OPERATORS.get(operator)
+            if expected is not None and not isinstance(operand, expected):
+                msg = '{} expects a {}, got {!r}'.format(operator, expected.__name__, operand)
+                raise DeuspyException(msg)
+            if operator == '$set':
+                doc.update(operand)
+            elif operator == '$unset':
+                for key in operand:
+                    doc.pop(key, None)
+            elif operator == '$inc':
+                for key, delta in operand.items():
+                    value = doc.get(key, 0)
+                    if not _is_number(value) or not _is_number(delta):
+                        msg = 'Can not increment {!r} by {!r}'.format(value, delta)
+                        raise DeuspyException(msg)
+                    doc[key] = value + delta
+            else:
+                raise DeuspyException('Unknown patch operator {!r}'.format(operator))
+        self._save(batch, uid, doc, old)
+        self._log(batch, 'patch', uid)
+        return doc
+
+    def _delete(self, batch, uid, version=None):
+        self._check(batch, uid, version)
+        key = pack((uid,), prefix=DOCS)
+        doc = self._load(batch.get(key))
         if doc is None:
             return False  # TODO: replace with an exception
         # delete from the index first...
-        for key, value in doc.items():
-            index = pack((key, value, uid))
-            self._index.delete(index)
+        self._reindex(batch, self._index_entries(doc, uid), dict())
         # ... and delete completly
-        key = pack((uid,))
-        self._docs.delete(key)
+        batch.delete(key)
+        batch.uids.add(uid)
+        self._increment(batch, META_COUNT, -1)
+        self._log(batch, 'delete', uid)
         return True
 
-    def update(self, uid, doc):
-        self.delete(uid)
-        self._save(doc, uid)
+    @timed('apply')
+    def apply(self, operations, sync=False):
+        """Execute `operations` in a single atomic write and return their
+        results.
 
-    def query(self, **kwargs):
-        if kwargs:
-            items = list(kwargs.items())
-            key, value = items[0]
-            rest = items[1:]
-
-            start = pack((key, value, 0))
-            stop = pack((key, value, sys.maxsize))
-
-            iterator = self._index.iterator(start=start, stop=stop, include_value=False)
-
-            for index in iterator:
-                _, _, uid = unpack(index)
-                for key, value in rest:
-                    index = pack((key, value, uid))
-                    if self._index.get(index) is None:
-                        break  # skip it
+        `operations` is a list of `(name, args)` pairs where `name` is
+        one of `create`, `update`, `patch` and `delete`. An operation that fails
+        does not write anything, its exception is returned in place of
+        its result and the other operations are still applied.
+
+        """
+        results = list()
+        with self._lock:
+            batch = Batch(self._db, sync, self._metrics)
+            for name, args in operations:
+                method = getattr(self, '_' + name)
+                start = perf_counter()
+                try:
+                    result = method(batch, *args)
+                except Exception as exc:
+                    result = exc
+                self._metrics.observe(name, perf_counter() - start)
+                results.append(result)
+            batch.write()
+            if self._cache is not None:
+                for uid in batch.uids:
+                    self._cache.invalidate(uid)
+                    self._cache.invalidate(('json', uid))
+            sequence = self._sequence
+        for listener in self._listeners:
+            listener(sequence)
+        return results
+
+    def _log(self, batch, name, uid):
+        """Append the operation `name` on `uid` to the change log and
+        bump the version of the document"""
+        self._sequence += 1
+        batch.put(pack((self._sequence,), prefix=CHANGES), pack((name, uid)))
+        key = pack((uid,), prefix=VERSIONS)
+        if name == 'delete':
+            batch.delete(key)
+        else:
+            batch.put(key, pack((self._sequence,)))
+
+    def changes(self, since=0, limit=None):
+        """Return the `(sequence, operation, uid)` of the changes after
+        the sequence number `since`, in the order they were written"""
+        iterator = self._changes.iterator(start=pack((since + 1,)))
+        iterator = islice(iterator, limit)
+        return [unpack(key) + unpack(value) for key, value in iterator]
+
+    def sequence(self):
+        """Return the sequence number of the last change"""
+        return self._sequence
+
+    def subscribe(self, listener):
+        """Call `listener` with the last sequence number after every
+        write, from the thread that wrote"""
+        self._listeners.append(listener)
+
+    def _apply(self, name, *args):
+        result, = self.apply([(name, args)])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def create(self, doc):
+        """Store `doc` and return it's unique identifier"""
+        return self._apply('create', doc)
+
+    def create_many(self, docs, size=1000):
+        """Store the documents of the iterable `docs`, `size` documents
+        per batch, and yield the unique identifier of every document or
+        the exception that prevented its creation"""
+        docs = iter(docs)
+        while True:
+            operations = [('create', (doc,)) for doc in islice(docs, size)]
+            if not operations:
+                return
+            yield from self.apply(operations)
+
+    @timed('read')
+    def read(self, uid):
+        """Retrieve the doc associated with `uid`"""
+        return self._read(uid)
+
+    def _read(self, uid):
+        key = pack((uid,))
+        if self._cache is None:
+            self._metrics.add('point_gets')
+            return self._load(self._docs.get(key))
+        doc = self._cache.get(uid)
+        if doc is None:
+            version = self._cache.version()
+            self._metrics.add('point_gets')
+            value = self._docs.get(key)
+            if value is None:
+                return None
+            doc = self._load(value)
+            self._cache.set(uid, doc, len(value), version)
+        # the cached doc must not be mutated by the caller
+        return copy(doc)
+
+    @timed('read_versioned')
+    def read_versioned(self, uid):
+        """Return the stored value of the doc associated with `uid` and
+        its version, `(None, None)` if there is no such doc"""
+        return self._read_versioned(uid)
+
+    def _read_versioned(self, uid):
+        # the version is read first, a concurrent write can only make
+        # it older than the value and never the other way around
+        version = self._counter(pack((uid,), prefix=VERSIONS))
+        value = self._docs.get(pack((uid,)))
+        self._metrics.add('point_gets', 2)
+        if value is None:
+            return None, None
+        return value, version
+
+    @timed('read_many')
+    def read_many_raw(self, uids):
+        """Return the `(uid, value)` pairs of the stored values of the
+        existing documents among `uids`, sorted by uid"""
+        return self._read_many_raw(uids)
+
+    def _read_many_raw(self, uids):
+        uids = sorted(set(uids))
+        out = list()
+        if len(uids) < READ_MANY_SEEK:
+            self._metrics.add('point_gets', len(uids))
+            for uid in uids:
+                value = self._docs.get(pack((uid,)))
+                if value is not None:
+                    out.append((uid, value))
+            return out
+        # seek forward a single iterator, so that the reads are mostly
+        # sequential
+        iterator = self._docs.iterator()
+        for uid in uids:
+            key = pack((uid,))
+            iterator.seek(key)
+            self._metrics.add('seeks')
+            try:
+                other, value = next(iterator)
+            except StopIteration:
+                break
+            if other == key:
+                out.append((uid, value))
+        return out
+
+    def read_many(self, uids):
+        """Return a dict mapping the uid of the existing documents among
+        `uids` to the document"""
+        if self._cache is None:
+            return {uid: self._load(value) for uid, value in self.read_many_raw(uids)}
+        out = dict()
+        missing = list()
+        for uid in uids:
+            doc = self._cache.get(uid)
+            if doc is None:
+                missing.append(uid)
+            else:
+                out[uid] = copy(doc)
+        if missing:
+            version = self._cache.version()
+            for uid, value in self.read_many_raw(missing):
+                doc = self._load(value)
+                self._cache.set(uid, doc, len(value), version)
+                out[uid] = copy(doc)
+        return out
+
+    def _to_json(self, value):
+        if document.format_of(value) != 'json':
+            self._metrics.add('documents_decoded')
+        return document.to_json(value)
+
+    @timed('read_json')
+    def read_json(self, uid):
+        """Return the JSON encoding of the doc associated with `uid` and
+        its version, `(None, None)` if there is no such doc. They are
+        cached along the decoded documents, see `read`."""
+        if self._cache is None:
+            value, version = self._read_versioned(uid)
+            return (None, None) if value is None else (self._to_json(value), version)
+        # the JSON encodings are cached next to the decoded documents
+        out = self._cache.get(('json', uid))
+        if out is None:
+            cache = self._cache.version()
+            value, version = self._read_versioned(uid)
+            if value is None:
+                return None, None
+            out = (self._to_json(value), version)
+            self._cache.set(('json', uid), out, len(out[0]), cache)
+        return out
+
+    @timed('read_many_json')
+    def read_many_json(self, uids):
+        """Return the `(uid, JSON encoded doc)` pairs of the existing
+        documents among `uids`, sorted by uid, see `read_json`"""
+        if self._cache is None:
+            return [(uid, self._to_json(value)) for uid, value in self._read_many_raw(uids)]
+        out = dict()
+        missing = list()
+        for uid in uids:
+            cached = self._cache.get(('json', uid))
+            if cached is None:
+                missing.append(uid)
+            else:
+                out[uid] = cached[0]
+        if missing:
+            cache = self._cache.version()
+            # versions first, like `read_versioned`
+            versions = {
+                uid: self._counter(pack((uid,), prefix=VERSIONS)) for uid in missing
+            }
+            self._metrics.add('point_gets', len(missing))
+            for uid, value in self._read_many_raw(missing):
+                out[uid] = self._to_json(value)
+                self._cache.set(('json', uid), (out[uid], versions[uid]), len(out[uid]), cache)
+        return sorted(out.items())
+
+    def cache_stats(self):
+        """Return the hits, misses, entries and bytes of the document
+        cache, which also holds JSON encodings, or `None` when it is
+        disabled"""
+        return None if self._cache is None else self._cache.stats()
+
+    def delete(self, uid, version=None):
+        """Delete the document associated with `uid`, if `version` is not
+        `None` the document must be at that version, see
+        `read_versioned`, otherwise `DeuspyConflict` is raised"""
+        return self._apply('delete', uid, version)
+
+    def update(self, uid, doc, version=None):
+        """Replace the document associated with `uid` with `doc`, if
+        `version` is not `None` the document must be at that version"""
+        self._apply('update', uid, doc, version)
+
+    def patch(self, uid, operations, version=None):
+        """Change some fields of the document associated with `uid` and
+        return the new document or `None` if there is no such document.
+        If `version` is not `None` the document must be at that version.
+
+        `operations` maps `$set` to a dict of the fields to set, `$unset`
+        to a list of the fields to remove and `$inc` to a dict of the
+        fields to increment by a number. Only the index entries of the
+        modified fields are written.
+
+        """
+        return self._apply('patch', uid, operations, version)
+
+    def estimate(self, predicate, limit=None):
+        """Return the number of documents matching `predicate`. The
+        counters of a range are summed until they exceed `limit`, the
+        estimate is then only known to be bigger than `limit`."""
+        if predicate.equality:
+            return self._counter(STATS + predicate.start)
+        iterators = [
+            self._stats.iterator(start=start, stop=stop, include_key=False)
+            for start, stop in predicate.ranges
+        ]
+        if limit is None:
+            return sum(unpack(value)[0] for value in chain.from_iterable(iterators))
+        out = 0
+        for value in chain.from_iterable(iterators):
+            out += unpack(value)[0]
+            if out > limit:
+                break
+        return out
+
+    def _plan(self, kwargs, driver=None):
+        """Return the `(estimate, predicate)` of the predicates answered
+        with the index, from the most selective to the least selective,
+        and the other predicates.
+
+        There is nothing to estimate for a single predicate nor when a
+        page resumes the scan of its `driver`, the estimates are then
+        `None`.
+
+        """
+        predicates = [Predicate(key, value) for key, value in kwargs.items()]
+        others = [predicate for predicate in predicates if not self._ready(predicate.key)]
+        ready = [predicate for predicate in predicates if self._ready(predicate.key)]
+        if driver is not None:
+            # resume the scan of a previous page from the same predicate
+            for position, predicate in enumerate(ready):
+                if predicate.key == driver:
+                    ready.insert(0, ready.pop(position))
+                    break
+            else:
+                raise DeuspyException('Cursor does not match the query')
+            return [(None, predicate) for predicate in ready], others
+        if len(ready) == 1:
+            return [(None, ready[0])], others
+        # equalities cost a single get, estimate them first so that the
+        # ranges stop summing their counters past the best estimate
+        ready.sort(key=lambda predicate: not predicate.equality)
+        plan = list()
+        best = None
+        for predicate in ready:
+            estimate = self.estimate(predicate, best)
+            best = estimate if best is None else min(best, estimate)
+            plan.append((estimate, predicate))
+        plan.sort(key=lambda x: x[0])
+        return plan, others
+
+    def explain(self, **kwargs):
+        """Return the plan `query(**kwargs)` would execute"""
+        plan, others = self._plan(kwargs)
+        if not plan:
+            return dict(
+                scan='docs',
+                predicates=[],
+                filters=[[p.key, p.value] for p in others],
+                estimate=self._counter(META_COUNT),
+            )
+        estimate, driver = plan[0]
+        if estimate is None:
+            estimate = self.estimate(driver)
+        if driver.equality:
+            scan = [p for _, p in plan if p.equality]
+            filters = [p for _, p in plan if not p.equality]
+        else:
+            scan = [driver]
+            filters = [p for _, p in plan[1:]]
+        return dict(
+            scan='index' if len(scan) == 1 else 'intersect',
+            predicates=[[p.key, p.value] for p in scan],
+            filters=[[p.key, p.value] for p in filters + others],
+            estimate=estimate,
+        )
+
+    def _intersect(self, stats, predicates, target=0):
+        """Leapfrog over the sorted uid ranges of the equality `predicates`,
+        yield the index key of the first predicate and the uid"""
+        ranges = [
+            (p.start, self._index.iterator(start=p.start, stop=p.stop, include_value=False))
+            for p in predicates
+        ]
+        # `target` is the smallest uid that can still be in every range,
+        # `agreed` is the number of consecutive ranges that contain it
+        agreed = 0
+        while True:
+            for prefix, iterator in ranges:
+                iterator.seek(prefix + pack((target,)))
+                stats['index_keys_scanned'] += 1
+                try:
+                    index = next(iterator)
+                except StopIteration:
+                    return
+                uid = unpack_at(index, len(prefix))[0]
+                if uid == target:
+                    agreed += 1
+                    if agreed == len(ranges):
+                        yield ranges[0][0] + pack((uid,)), uid
+                        target = uid + 1
+                        agreed = 0
                 else:
-                    # all the kwargs match
-                    yield uid
+                    target = uid
+                    agreed = 1
+
+    def _scan(self, stats, predicate, start=None):
+        """Yield the index keys matching `predicate` and their uid"""
+        for low, high in predicate.ranges:
+            iterator = self._index.iterator(
+                start=max(low, start or b''), stop=high, include_value=False
+            )
+            # the uid follows the field and the value of the index key,
+            # only decode it
+            if predicate.equality:
+                offset = len(predicate.start)
+                for index in iterator:
+                    stats['index_keys_scanned'] += 1
+                    yield index, unpack_at(index, offset)[0]
+            else:
+                offset = len(predicate.field)
+                for index in iterator:
+                    stats['index_keys_scanned'] += 1
+                    yield index, unpack_at(index, skip(index, offset))[0]
+
+    def _filter(self, stats, items, predicates):
+        """Yield the `items` whose document match every of `predicates`"""
+        equalities = [p for p in predicates if p.equality and self._ready(p.key)]
+        others = [p for p in predicates if p not in equalities]
+        for key, uid in items:
+            # equalities are checked against the index...
+            for predicate in equalities:
+                index = pack((predicate.key, predicate.value, uid))
+                stats['point_gets'] += 1
+                if self._index.get(index) is None:
+                    break  # skip it
+            else:
+                # ... the others against the document
+                if others:
+                    stats['documents_read'] += 1
+                    doc = self._read(uid)
+                    if doc is None or not all(p.match(doc) for p in others):
+                        continue  # skip it
+                # all the kwargs match
+                yield key, uid
+
+    def _query(self, stats, plan, others, after=None):
+        """Yield the keys scanned by `plan` and the uid of the documents
+        matching it and the `others` predicates, resuming right after the
+        key `after`"""
+        if not plan:
+            start = None if after is None else after + b'\x00'
+            if not others:
+                for key in self._docs.iterator(start=start, include_value=False):
+                    stats['document_keys_scanned'] += 1
+                    yield key, unpack_at(key, 0)[0]
+                return
+            # filter the documents as they are scanned
+            for key, value in self._docs.iterator(start=start):
+                stats['document_keys_scanned'] += 1
+                stats['documents_decoded'] += 1
+                doc = document.loads(value)
+                if all(p.match(doc) for p in others):
+                    yield key, unpack_at(key, 0)[0]
+            return
+        estimate, driver = plan[0]
+        if estimate == 0:
+            return  # nothing to see
+        if driver.equality:
+            # intersect every equality predicate using the index...
+            scan = [p for _, p in plan if p.equality]
+            filters = [p for _, p in plan if not p.equality]
+            if len(scan) == 1:
+                items = self._scan(stats, driver, None if after is None else after + b'\x00')
+            else:
+                target = 0 if after is None else unpack(after)[-1] + 1
+                items = self._intersect(stats, scan, target)
+        else:
+            # ... or scan the most selective range
+            items = self._scan(stats, driver, None if after is None else after + b'\x00')
+            filters = [p for _, p in plan[1:]]
+        yield from self._filter(stats, items, filters + others)
+
+    def _traced(self, operation, query, stats, items):
+        """Yield the `items` of `operation` and observe the time spent
+        producing them once they are exhausted or closed"""
+        elapsed = 0
+        count = 0
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += perf_counter() - start
+                count += 1
+                yield item
+        finally:
+            self._done(operation, query, stats, elapsed, count)
+
+    def _done(self, operation, query, stats, elapsed, results):
+        """Account for the `operation` on `query` that took `elapsed`
+        seconds and log it if it is slow"""
+        self._metrics.observe(operation, elapsed)
+        self._metrics.merge(stats)
+        if self._slow_query is not None and elapsed >= self._slow_query:
+            log.warning(
+                'slow %s of %r: %.3f seconds, %d results, %s',
+                operation, query, elapsed, results, dict(stats),
+            )
+
+    def query(self, **kwargs):
+        """Yield the uids of the documents matching `kwargs`.
+
+        Values are either compared for equality or a dict of operators
+        among `$gt`, `$gte`, `$lt`, `$lte`, `$between` and `$prefix`
+        answered with a range scan over the index. Predicates on fields
+        that are not indexed are checked against the documents.
+
+        """
+        # compile the predicates now, so that errors are raised early
+        plan, others = self._plan(kwargs)
+        stats = Counter()
+        items = self._traced('query', kwargs, stats, self._query(stats, plan, others))
+        return (uid for _, uid in items)
+
+    def select(self, query, fields):
+        """Yield the uid and the `fields` of the documents matching the
+        `query` dict.
+
+        When `query` has a single predicate on a covering index that
+        stores every of `fields`, the documents are not read.
+
+        """
+        plan, others = self._plan(query)
+        stats = Counter()
+        if len(plan) == 1 and not others:
+            _, predicate = plan[0]
+            projection = self._covering(predicate.key)
+            if projection is not None and set(fields) <= set(projection) | {predicate.key}:
+                items = self._select_covering(stats, predicate, fields)
+                return self._traced('select', query, stats, items)
+        uids = (uid for _, uid in self._query(stats, plan, others))
+        return self._traced('select', query, stats, self._select(stats, uids, fields))
+
+    def _select(self, stats, uids, fields):
+        for uid in uids:
+            stats['documents_read'] += 1
+            doc = self._read(uid)
+            if doc is not None:
+                yield uid, {field: doc[field] for field in fields if field in doc}
+
+    def _select_covering(self, stats, predicate, fields):
+        iterators = [
+            self._index.iterator(start=start, stop=stop) for start, stop in predicate.ranges
+        ]
+        offset = len(predicate.field)
+        for index, entry in chain.from_iterable(iterators):
+            stats['index_keys_scanned'] += 1
+            stats['documents_decoded'] += 1
+            value, position = unpack_at(index, offset)
+            uid = unpack_at(index, position)[0]
+            projection = document.loads(entry)
+            doc = {field: projection[field] for field in fields if field in projection}
+            if predicate.key in fields:
+                doc[predicate.key] = value
+            yield uid, doc
+
+    def page(self, query, limit, cursor=None):
+        """Return at most `limit` uids matching the `query` dict and the
+        cursor of the next page.
+
+        The cursor is `None` when there is no more results. Otherwise it
+        is an opaque string that encodes the last key visited, the next
+        page starts right after it whatever the number of pages before.
+
+        """
+        if limit < 1:
+            raise DeuspyException('The limit must be positive, got {!r}'.format(limit))
+        if cursor is None:
+            after = None
+            plan, others = self._plan(query)
+        else:
+            try:
+                driver, after = unpack(urlsafe_b64decode(cursor))
+            except Exception:
+                raise DeuspyException('Invalid cursor')
+            plan, others = self._plan(query, driver)
+            if (driver is None) != (not plan):
+                raise DeuspyException('Cursor does not match the query')
+        stats = Counter()
+        traced = self._traced('page', query, stats, self._query(stats, plan, others, after))
+        items = list(islice(traced, limit))
+        # account for the page now rather than when it is collected
+        traced.close()
+        if len(items) < limit:
+            return [uid for _, uid in items], None
+        key, _ = items[-1]
+        driver = plan[0][1].key if plan else None
+        cursor = urlsafe_b64encode(pack((driver, key))).decode('ascii')
+        return [uid for _, uid in items], cursor
+
+    def count(self, **kwargs):
+        """Return the number of documents matching `kwargs`, computed from
+        the counters and the index without reading the documents, every
+        predicate must be on an indexed field"""
+        start = perf_counter()
+        stats = Counter()
+        count = self._count(stats, kwargs)
+        self._done('count', kwargs, stats, perf_counter() - start, count)
+        return count
+
+    def _count(self, stats, kwargs):
+        if not kwargs:
+            return self._counter(META_COUNT)
+        plan, others = self._plan(kwargs)
+        if others:
+            msg = 'Can not count on {!r} which is not indexed'
+            raise DeuspyException(msg.format(others[0].key))
+        estimate, driver = plan[0]
+        if len(plan) == 1:
+            # the counters are exact
+            return self.estimate(driver)
+        if estimate == 0:
+            return 0
+        equalities = [p for _, p in plan if p.equality]
+        ranges = [p for _, p in plan if not p.equality]
+        if len(equalities) > 1:
+            items = self._intersect(stats, equalities)
+        elif equalities:
+            items = self._scan(stats, equalities[0])
         else:
-            for key in self._docs.iterator(include_value=False):
-                uid = unpack(key)[0]
-                yield uid
+            items = self._scan(stats, ranges.pop(0))
+        # the candidates are looked up in the other ranges, from the most
+        # selective, each scan stops once every candidate is found
+        candidates = {uid for _, uid in items}
+        for predicate in ranges:
+            if not candidates:
+                break
+            found = set()
+            for _, uid in self._scan(stats, predicate):
+                if uid in candidates:
+                    found.add(uid)
+                    if len(found) == len(candidates):
+                        break
+            candidates = found
+        return len(candidates)
+
+    def _values(self, key):
+        """Yield the values of `key` and their number of documents"""
+        if not self._ready(key):
+            msg = 'Field {!r} is not indexed'
+            raise DeuspyException(msg.format(key))
+        prefix = pack((key,))
+        offset = len(prefix)
+        for stat, value in self._stats.iterator(prefix=prefix):
+            yield unpack_at(stat, offset)[0], unpack(value)[0]
+
+    @timed('distinct')
+    def distinct(self, key):
+        """Return the sorted list of the values of `key`"""
+        return [value for value, _ in self._values(key)]
+
+    @timed('group_by')
+    def group_by(self, key):
+        """Return the sorted list of the values of `key` and their number
+        of documents, as `(value, count)` pairs"""
+        return list(self._values(key))
@@ -0,0 +1,70 @@
+"""Encoding of the documents stored in the docs: keyspace.
+
+Documents are stored either as JSON, which is what older databases
+contain, or in a binary format made of a leading format byte followed by
+the document serialized with `pickle` protocol 4. Unlike `marshal`, the
+pickle protocols are documented and stay readable by later versions of
+Python. Documents only hold JSON types, so the unpickler refuses to load
+any class. A JSON document always starts with `{`, so both formats can
+live side by side and be read transparently, see `Deuspy.migrate`.
+
+"""
+import io
+import json
+import pickle
+
+from deuspy.base import DeuspyException
+
+
+FORMATS = ('binary', 'json')
+
+# leading byte of documents in pickle protocol 4, a new format must use
+# a new byte
+PICKLE_V4 = 0x01
+
+_HEADER = bytes((PICKLE_V4,))
+
+
+class _Unpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        msg = 'Documents can not hold {}.{}'.format(module, name)
+        raise DeuspyException(msg)
+
+
+def dumps(doc, format='binary'):
+    """Encode `doc` in `format`"""
+    if format == 'binary':
+        return _HEADER + pickle.dumps(doc, 4)
+    else:
+        return json.dumps(doc).encode('utf-8')
+
+
+def loads(value):
+    """Decode a document whatever its format"""
+    code = value[0]
+    if code == PICKLE_V4:
+        return _Unpickler(io.BytesIO(memoryview(value)[1:])).load()
+    elif code == 0x7b:  # {
+        return json.loads(value.decode('utf-8'))
+    else:
+        msg = 'Unknown document format {!r}'.format(value[:1])
+        raise DeuspyException(msg)
+
+
+def format_of(value):
+    """Return the format `value` is encoded with"""
+    code = value[0]
+    if code == PICKLE_V4:
+        return 'binary'
+    else:
+        return 'json'
+
+
+def to_json(value):
+    """Return the JSON encoding of the stored `value`, as-is when it is
+    stored as JSON"""
+    if format_of(value) == 'json':
+        return value
+    else:
+        return json.dumps(loads(value)).encode('utf-8')
@@ -0,0 +1,84 @@
+import asyncio
+
+from deuspy.metrics import Metrics
+
+
+# upper bounds of the buckets of the histogram of the batch sizes
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class GroupCommit:
+    """Coalesce the writes submitted within `window` seconds, or up to
+    `size` operations, into a single `Deuspy.apply` batch.
+
+    Only one batch is committed at a time, the operations submitted
+    meanwhile are part of the next batch. With `sync=True` every batch
+    waits for the disk, which is amortized over all its operations.
+
+    """
+
+    def __init__(self, deuspy, executor, window=0, size=256, sync=False):
+        self._deuspy = deuspy
+        self._executor = executor
+        self.window = window
+        self.size = size
+        self.sync = sync
+        self._pending = list()
+        self._timer = None
+        self._committing = False
+        # the number of operations of the batches
+        self.metrics = Metrics(
+            'deuspy_', 'commit', unit='operations', buckets=BATCH_BUCKETS,
+            help='Number of operations per batch written by the group commit',
+        )
+
+    async def submit(self, name, *args):
+        """Schedule the `name` operation and return its result once the
+        batch it belongs to is written"""
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(((name, args), future))
+        self._schedule()
+        return await future
+
+    def _schedule(self):
+        if self._committing or not self._pending:
+            return  # the next batch starts when the current one is done
+        if len(self._pending) >= self.size:
+            self._start()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, self._start)
+
+    def _start(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._committing or not self._pending:
+            return
+        self._committing = True
+        batch = self._pending[:self.size]
+        self._pending = self._pending[self.size:]
+        asyncio.ensure_future(self._commit(batch))
+
+    async def _commit(self, batch):
+        operations = [operation for operation, _ in batch]
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self._deuspy.apply, operations, self.sync
+            )
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue  # the request was cancelled
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self.metrics.observe('batch', len(batch))
+            self._committing = False
+            self._schedule()
@@ -0,0 +1,114 @@
+"""Counters and latency histograms in the Prometheus text format"""
+from bisect import bisect_left
+from collections import Counter
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+
+# upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+    2.5, 5, 10,
+)
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for the values above the biggest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters and latency histograms, they can be updated from several
+    threads.
+
+    The histograms are named `<prefix><label>_<unit>` and labelled by
+    `label`, `counters` maps the name of the counters to their help and
+    they are exposed as `<prefix><counter>_total`. Histograms of other
+    values than durations take their `unit`, `buckets` and `help`.
+
+    """
+
+    def __init__(self, prefix, label, counters=None, unit='seconds', buckets=BUCKETS, help=None):
+        self.prefix = prefix
+        self.label = label
+        self.counters = counters or dict()
+        self.unit = unit
+        self.buckets = buckets
+        self.help = help or 'Duration of the {}s in seconds'.format(label)
+        self._counts = Counter()
+        self._histograms = dict()
+        self._lock = Lock()
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self._counts[counter] += value
+
+    def merge(self, counts):
+        """Add the `counts` of the counters, other names are ignored"""
+        with self._lock:
+            for counter, value in counts.items():
+                if counter in self.counters:
+                    self._counts[counter] += value
+
+    def observe(self, label, seconds):
+        with self._lock:
+            try:
+                histogram = self._histograms[label]
+            except KeyError:
+                histogram = self._histograms[label] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, counter):
+        return self._counts[counter]
+
+    def render(self):
+        """Return the counters and the histograms in the Prometheus text
+        exposition format"""
+        lines = list()
+        with self._lock:
+            for counter, help in sorted(self.counters.items()):
+                name = self.prefix + counter + '_total'
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, self._counts[counter]))
+            name = self.prefix + self.label + '_' + self.unit
+            lines.append('# HELP {} {}'.format(name, self.help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for label, histogram in sorted(self._histograms.items()):
+                labels = '{}="{}"'.format(self.label, label)
+                cumulative = 0
+                bounds = [repr(float(bound)) for bound in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, cumulative
+                    ))
+                lines.append('{}_sum{{{}}} {!r}'.format(name, labels, histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(operation):
+    """Decorate a method to observe its duration in the `_metrics` of
+    its instance as `operation`"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._metrics.observe(operation, perf_counter() - start)
+        return wrapper
+    return decorator
@@ -333,6 +333,243 @@ def _encode(value, nested=False):
         raise ValueError("Unsupported data type: " + str(type(value)))
 
 
+# Table-driven codec used by pack and unpack. It produces the same bytes
+# as _encode and _decode, which remain the reference implementation and
+# handle the less common types (single floats, ctypes, versionstamps).
+
+_CODES = tuple(bytes((code,)) for code in range(256))
+_NULL = _CODES[NULL_CODE]
+_NESTED_NULL = _CODES[NULL_CODE] + b'\xff'
+_NESTED_END = _CODES[0x00]
+_INT_ZERO = _CODES[INT_ZERO_CODE]
+_SIGN_64 = 1 << 63
+_MASK_64 = (1 << 64) - 1
+_DOUBLE = struct.Struct('>d')
+_UINT64 = struct.Struct('>Q')
+
+
+def _encode_none(value, nested):
+    return _NESTED_NULL if nested else _NULL
+
+
+def _encode_bytes(value, nested):
+    return b''.join((_CODES[BYTES_CODE], value.replace(b'\x00', b'\x00\xff'), b'\x00'))
+
+
+def _encode_string(value, nested):
+    value = value.encode('utf-8')
+    if b'\x00' in value:
+        value = value.replace(b'\x00', b'\x00\xff')
+    return b''.join((_CODES[STRING_CODE], value, b'\x00'))
+
+
+def _encode_int(value, nested):
+    if value == 0:
+        return _INT_ZERO
+    elif value > 0:
+        # the number of bytes is what bisect_left(_size_limits, value) gives
+        n = (value.bit_length() + 7) // 8
+        if n > 8 or value == _size_limits[-1]:
+            return _CODES[POS_INT_END] + _CODES[n] + value.to_bytes(n, 'big')
+        return _CODES[INT_ZERO_CODE + n] + value.to_bytes(n, 'big')
+    else:
+        n = (value.bit_length() + 7) // 8
+        if n > 8 or value == -_size_limits[-1]:
+            value += (1 << (n * 8)) - 1
+            return _CODES[NEG_INT_START] + _CODES[n ^ 0xff] + value.to_bytes(n, 'big')
+        return _CODES[INT_ZERO_CODE - n] + (_size_limits[n] + value).to_bytes(n, 'big')
+
+
+def _encode_bool(value, nested):
+    # booleans are integers
+    return _encode_int(int(value), nested)
+
+
+def _encode_double(value, nested):
+    # same as _float_adjust on the 64 bits integer
+    bits = _UINT64.unpack(_DOUBLE.pack(value))[0]
+    bits = bits ^ _MASK_64 if bits & _SIGN_64 else bits ^ _SIGN_64
+    return _CODES[DOUBLE_CODE] + _UINT64.pack(bits)
+
+
+def _encode_uuid(value, nested):
+    return _CODES[UUID_CODE] + value.bytes
+
+
+def _encode_nested(value, nested):
+    out = [_CODES[NESTED_CODE]]
+    out.extend([_encode_fast(item, True) for item in value])
+    out.append(_NESTED_END)
+    return b''.join(out)
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bytes: _encode_bytes,
+    str: _encode_string,
+    int: _encode_int,
+    bool: _encode_bool,
+    float: _encode_double,
+    uuid.UUID: _encode_uuid,
+    tuple: _encode_nested,
+    list: _encode_nested,
+}
+
+
+def _encode_fast(value, nested=False):
+    try:
+        encoder = _ENCODERS[type(value)]
+    except KeyError:
+        out, version_pos = _encode(value, nested)
+        if version_pos >= 0:
+            raise ValueError("Incomplete versionstamp included in vanilla tuple pack")
+        return out
+    return encoder(value, nested)
+
+
+def _decode_null(v, pos):
+    return None, pos + 1
+
+
+def _decode_bytes(v, pos):
+    end = v.find(b'\x00', pos + 1)
+    if end < 0 or v[end + 1:end + 2] == b'\xff':
+        end = _find_terminator(v, pos + 1)
+        return v[pos + 1:end].replace(b"\x00\xff", b"\x00"), end + 1
+    return v[pos + 1:end], end + 1
+
+
+def _decode_string(v, pos):
+    value, end = _decode_bytes(v, pos)
+    return value.decode('utf-8'), end
+
+
+def _decode_positive(v, pos):
+    end = pos + 1 + v[pos] - INT_ZERO_CODE
+    return int.from_bytes(v[pos + 1:end], 'big'), end
+
+
+def _decode_negative(v, pos):
+    n = INT_ZERO_CODE - v[pos]
+    end = pos + 1 + n
+    return int.from_bytes(v[pos + 1:end], 'big') - _size_limits[n], end
+
+
+def _decode_double(v, pos):
+    bits = _UINT64.unpack_from(v, pos + 1)[0]
+    bits = bits ^ _SIGN_64 if bits & _SIGN_64 else bits ^ _MASK_64
+    return _DOUBLE.unpack(_UINT64.pack(bits))[0], pos + 9
+
+
+def _decode_false(v, pos):
+    return False, pos + 1
+
+
+def _decode_true(v, pos):
+    return True, pos + 1
+
+
+def _decode_nested(v, pos):
+    out = []
+    end = pos + 1
+    size = len(v)
+    while end < size:
+        if v[end] == 0x00:
+            if end + 1 < size and v[end + 1] == 0xff:
+                out.append(None)
+                end += 2
+            else:
+                break
+        else:
+            value, end = _DECODERS[v[end]](v, end)
+            out.append(value)
+    return tuple(out), end + 1
+
+
+_DECODERS = [_decode for _ in range(256)]
+_DECODERS[NULL_CODE] = _decode_null
+_DECODERS[BYTES_CODE] = _decode_bytes
+_DECODERS[STRING_CODE] = _decode_string
+_DECODERS[NESTED_CODE] = _decode_nested
+for code in range(INT_ZERO_CODE + 1, POS_INT_END):
+    _DECODERS[code] = _decode_positive
+_DECODERS[INT_ZERO_CODE] = _decode_positive
+for code in range(NEG_INT_START + 1, INT_ZERO_CODE):
+    _DECODERS[code] = _decode_negative
+_DECODERS[DOUBLE_CODE] = _decode_double
+_DECODERS[FALSE_CODE] = _decode_false
+_DECODERS[TRUE_CODE] = _decode_true
+del code
+
+
+# Skipping over elements finds where the next one starts without decoding,
+# hence without allocating, the elements in between.
+
+
+def _skip_fixed(length):
+    def skip(v, pos):
+        return pos + length
+    return skip
+
+
+def _skip_terminated(v, pos):
+    return _find_terminator(v, pos + 1) + 1
+
+
+def _skip_positive(v, pos):
+    return pos + 1 + v[pos] - INT_ZERO_CODE
+
+
+def _skip_negative(v, pos):
+    return pos + 1 + INT_ZERO_CODE - v[pos]
+
+
+def _skip_big_positive(v, pos):
+    return pos + 2 + v[pos + 1]
+
+
+def _skip_big_negative(v, pos):
+    return pos + 2 + (v[pos + 1] ^ 0xff)
+
+
+def _skip_nested(v, pos):
+    pos += 1
+    size = len(v)
+    while pos < size:
+        if v[pos] == 0x00:
+            if pos + 1 < size and v[pos + 1] == 0xff:
+                pos += 2
+            else:
+                break
+        else:
+            pos = _SKIPPERS[v[pos]](v, pos)
+    return pos + 1
+
+
+def _skip_unknown(v, pos):
+    raise ValueError("Unknown data type in DB: " + repr(v))
+
+
+_SKIPPERS = [_skip_unknown for _ in range(256)]
+_SKIPPERS[NULL_CODE] = _skip_fixed(1)
+_SKIPPERS[BYTES_CODE] = _skip_terminated
+_SKIPPERS[STRING_CODE] = _skip_terminated
+_SKIPPERS[NESTED_CODE] = _skip_nested
+for code in range(INT_ZERO_CODE, POS_INT_END):
+    _SKIPPERS[code] = _skip_positive
+for code in range(NEG_INT_START + 1, INT_ZERO_CODE):
+    _SKIPPERS[code] = _skip_negative
+_SKIPPERS[POS_INT_END] = _skip_big_positive
+_SKIPPERS[NEG_INT_START] = _skip_big_negative
+_SKIPPERS[FLOAT_CODE] = _skip_fixed(5)
+_SKIPPERS[DOUBLE_CODE] = _skip_fixed(9)
+_SKIPPERS[FALSE_CODE] = _skip_fixed(1)
+_SKIPPERS[TRUE_CODE] = _skip_fixed(1)
+_SKIPPERS[UUID_CODE] = _skip_fixed(17)
+_SKIPPERS[VERSIONSTAMP_CODE] = _skip_fixed(1 + Versionstamp.LENGTH)
+del code
+
+
 # packs the tuple possibly for versionstamp operations and returns the position of the
 # incomplete versionstamp
 #  * if there are no incomplete versionstamp members, this returns the packed tuple and -1
@@ -358,10 +595,31 @@ def _pack_maybe_with_versionstamp(t, prefix=None):
 
 # packs the specified tuple into a key
 def pack(t, prefix=None):
-    res, version_pos = _pack_maybe_with_versionstamp(t, prefix)
-    if version_pos >= 0:
-        raise ValueError("Incomplete versionstamp included in vanilla tuple pack")
-    return res
+    if not isinstance(t, tuple):
+        raise Exception("fdbtuple pack() expects a tuple, got a " + str(type(t)))
+    out = [] if prefix is None else [prefix]
+    for value in t:
+        # inline the most common types of index keys
+        kind = type(value)
+        if kind is str:
+            value = value.encode('utf-8')
+            if b'\x00' in value:
+                value = value.replace(b'\x00', b'\x00\xff')
+            out.append(_CODES[STRING_CODE])
+            out.append(value)
+            out.append(b'\x00')
+        elif kind is int and 0 < value < _size_limits[-1]:
+            n = (value.bit_length() + 7) // 8
+            out.append(_CODES[INT_ZERO_CODE + n])
+            out.append(value.to_bytes(n, 'big'))
+        else:
+            out.append(_encode_fast(value))
+    return b''.join(out)
+
+
+# packs every tuple of the iterable `ts`
+def pack_many(ts, prefix=None):
+    return [pack(t, prefix) for t in ts]
 
 
 # packs the specified tuple into a key for versionstamp operations
@@ -374,9 +632,57 @@ def pack_with_versionstamp(t, prefix=None):
 
 # unpacks the specified key into a tuple
 def unpack(key, prefix_len=0):
+    decoders = _DECODERS
     pos = prefix_len
+    size = len(key)
     res = []
-    while pos < len(key):
-        r, pos = _decode(key, pos)
+    while pos < size:
+        # inline the most common types of index keys
+        code = key[pos]
+        if code == STRING_CODE:
+            end = key.find(b'\x00', pos + 1)
+            if end >= 0 and key[end + 1:end + 2] != b'\xff':
+                res.append(key[pos + 1:end].decode('utf-8'))
+                pos = end + 1
+                continue
+        elif INT_ZERO_CODE < code < POS_INT_END:
+            end = pos + 1 + code - INT_ZERO_CODE
+            res.append(int.from_bytes(key[pos + 1:end], 'big'))
+            pos = end
+            continue
+        r, pos = decoders[code](key, pos)
         res.append(r)
     return tuple(res)
+
+
+# unpacks every key of the iterable `keys`
+def unpack_many(keys, prefix_len=0):
+    return [unpack(key, prefix_len) for key in keys]
+
+
+# returns the position of the element that follows the element at `pos`
+def skip(key, pos=0, count=1):
+    for _ in range(count):
+        pos = _SKIPPERS[key[pos]](key, pos)
+    return pos
+
+
+# unpacks the single element at `pos` and returns it with the position
+# of the next element
+def unpack_at(key, pos):
+    return _DECODERS[key[pos]](key, pos)
+
+
+# unpacks only the element of the packed tuple `key` at `index`, the
+# elements before it are skipped, a negative index counts from the end
+def unpack_element(key, index, prefix_len=0):
+    pos = prefix_len
+    if index < 0:
+        positions = []
+        while pos < len(key):
+            positions.append(pos)
+            pos = _SKIPPERS[key[pos]](key, pos)
+        pos = positions[index]
+    else:
+        pos = skip(key, pos, index)
+    return _DECODERS[key[pos]](key, pos)[0]
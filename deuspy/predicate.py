@@ -0,0 +1,186 @@
+import math
+
+from deuspy.base import DeuspyException
+from deuspy.packing import BYTES_CODE
+from deuspy.packing import DOUBLE_CODE
+from deuspy.packing import FLOAT_CODE
+from deuspy.packing import NEG_INT_START
+from deuspy.packing import POS_INT_END
+from deuspy.packing import STRING_CODE
+from deuspy.packing import pack
+
+
+OPERATORS = ('$gt', '$gte', '$lt', '$lte', '$between', '$prefix')
+
+# the type codes of integers and of floats, numbers are looked up in both
+INTEGERS = (NEG_INT_START, POS_INT_END + 1)
+FLOATS = (FLOAT_CODE, DOUBLE_CODE + 1)
+
+
+def _family(value):
+    """Return the range of type codes values comparable with `value` are
+    packed with, so that eg. `$gt 'a'` does not match numbers"""
+    if isinstance(value, bytes):
+        return BYTES_CODE, BYTES_CODE + 1
+    elif isinstance(value, str):
+        return STRING_CODE, STRING_CODE + 1
+    else:
+        return None
+
+
+def _to_int(operator, operand):
+    """Return the operator and the integer operand matching the same
+    integers as `operator` on the number `operand`, `None` when every
+    integer matches and `False` when none does"""
+    if isinstance(operand, int):
+        return operator, operand
+    if math.isnan(operand):
+        return False
+    if math.isinf(operand):
+        if (operand > 0) == (operator in ('$gt', '$gte')):
+            return False
+        return None
+    if operator == '$gt':
+        return '$gte', math.floor(operand) + 1
+    elif operator == '$gte':
+        return '$gte', math.ceil(operand)
+    elif operator == '$lt':
+        return '$lt', math.ceil(operand)
+    else:  # $lte
+        return '$lte', math.floor(operand)
+
+
+def _to_float(operator, operand):
+    """Return the operator and the float operand matching the same floats
+    as `operator` on the number `operand`"""
+    if isinstance(operand, float):
+        return operator, operand
+    try:
+        value = float(operand)
+    except OverflowError:
+        value = math.copysign(math.inf, operand)
+    # no float is between `operand` and the closest float `value`
+    if operator == '$gt' and value > operand:
+        return '$gte', value
+    elif operator == '$gte' and value < operand:
+        return '$gt', value
+    elif operator == '$lt' and value < operand:
+        return '$lte', value
+    elif operator == '$lte' and value > operand:
+        return '$lt', value
+    return operator, value
+
+
+def _pack(key, value):
+    try:
+        return pack((key, value))
+    except ValueError:
+        raise DeuspyException('Can not compare {!r} with {!r}'.format(key, value))
+
+
+def _bound(key, operator, operand):
+    """Return the range of the index keys of `key` matching `operator`
+    on `operand`"""
+    field = pack((key,))
+    value = _pack(key, operand)
+    if operator == '$gt':
+        return value + b'\xff', field + b'\xff'
+    elif operator == '$gte':
+        return value, field + b'\xff'
+    elif operator == '$lt':
+        return field, value
+    else:  # $lte
+        return field, value + b'\xff'
+
+
+def _intersect(ranges, others):
+    """Return the intersection of two sorted lists of disjoint ranges"""
+    out = list()
+    for start, stop in ranges:
+        for other_start, other_stop in others:
+            start_, stop_ = max(start, other_start), min(stop, other_stop)
+            if start_ < stop_:
+                out.append((start_, stop_))
+    return out
+
+
+class Predicate:
+    """Compile `key` and `value` into the `ranges` of the index keys
+    matching them, sorted `(start, stop)` pairs.
+
+    `value` is either the value `key` must be equal to or a dict mapping
+    operators to their operand, eg. `{'$gte': 1, '$lt': 10}`. Integers
+    and floats are packed with different type codes, the operators on
+    numbers match both.
+
+    """
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        # the common prefix of the index keys of `key`
+        self.field = field = pack((key,))
+        if not isinstance(value, dict):
+            self.start = _pack(key, value)
+            self.stop = self.start + b'\xff'
+            self.ranges = [(self.start, self.stop)]
+            return
+        if not value:
+            raise DeuspyException('Empty operator predicate on {!r}'.format(key))
+        self.ranges = [(field, field + b'\xff')]
+        for operator, operand in value.items():
+            if operator not in OPERATORS:
+                raise DeuspyException('Unknown operator {!r}'.format(operator))
+            if operator == '$between':
+                try:
+                    low, high = operand
+                except (TypeError, ValueError):
+                    msg = '$between expects a pair of values, got {!r}'.format(operand)
+                    raise DeuspyException(msg)
+                self._restrict('$gte', low)
+                self._restrict('$lte', high)
+            elif operator == '$prefix':
+                if not isinstance(operand, str):
+                    raise DeuspyException('$prefix expects a string, got {!r}'.format(operand))
+                # a packed string without its terminator
+                start = _pack(key, operand)[:-1]
+                self.ranges = _intersect(self.ranges, [(start, start + b'\xff')])
+            else:
+                self._restrict(operator, operand)
+
+    def _restrict(self, operator, operand):
+        field = self.field
+        if isinstance(operand, (int, float)):
+            ranges = list()
+            for (low, high), convert in ((INTEGERS, _to_int), (FLOATS, _to_float)):
+                family = [(field + bytes((low,)), field + bytes((high,)))]
+                bound = convert(operator, operand)
+                if bound is False:
+                    continue
+                if bound is not None:
+                    family = _intersect(family, [_bound(self.key, *bound)])
+                ranges.extend(family)
+        else:
+            ranges = [_bound(self.key, operator, operand)]
+            family = _family(operand)
+            if family is not None:
+                low, high = family
+                ranges = _intersect(ranges, [(field + bytes((low,)), field + bytes((high,)))])
+        self.ranges = _intersect(self.ranges, ranges)
+
+    @property
+    def equality(self):
+        return not isinstance(self.value, dict)
+
+    def match(self, doc):
+        """Return whether `doc` satisfies the predicate"""
+        try:
+            value = pack((self.key, doc[self.key]))
+        except KeyError:
+            return False
+        except ValueError:
+            return False  # dicts are not comparable
+        return any(start <= value < stop for start, stop in self.ranges)
+
+    def __repr__(self):
+        return '<Predicate {!r} {!r}>'.format(self.key, self.value)
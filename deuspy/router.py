@@ -0,0 +1,445 @@
+"""Sharded mode: a router in front of several deuspy servers.
+
+Every shard is a `deuspy.server` process with its own LevelDB directory.
+Shards make uids congruent to their number modulo the number of shards,
+so that single document operations go straight to the owning shard.
+Queries are scattered across the shards and their results merged.
+
+"""
+import argparse
+import asyncio
+import json
+import logging
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from contextlib import AsyncExitStack
+from itertools import cycle
+from multiprocessing import Process
+from pathlib import Path
+from urllib.parse import quote
+
+import aiohttp
+import daiquiri
+from aiohttp import web
+
+from deuspy.packing import pack
+from deuspy.packing import unpack
+from deuspy.server import BULK_CHUNK_SIZE
+from deuspy.server import CURSOR
+from deuspy.server import NDJSON
+from deuspy.server import app_kwargs
+from deuspy.server import arguments
+from deuspy.server import make_app
+from deuspy.server import request_to_kwargs
+
+
+# request headers passed to the shards
+FORWARD = ('Accept', 'Content-Type', 'If-Match', 'If-None-Match')
+
+
+def shard_of(request, uid):
+    """Return the url of the shard owning `uid`"""
+    shards = request.app['shards']
+    return shards[uid % len(shards)]
+
+
+def headers_of(request):
+    return {key: request.headers[key] for key in FORWARD if key in request.headers}
+
+
+def error(response, body):
+    """Return the error `response` of a shard as is"""
+    return web.Response(
+        status=response.status, reason=response.reason, body=body,
+        content_type=response.content_type,
+    )
+
+
+def merge_objects(bodies):
+    """Merge the JSON encoded objects `bodies` without decoding them"""
+    items = [body.strip()[1:-1].strip() for body in bodies]
+    body = b'{' + b', '.join(item for item in items if item) + b'}'
+    return web.Response(body=body, content_type='application/json')
+
+
+async def scatter(request, method, path, bodies):
+    """Send the request to every shard with its body in `bodies` and
+    return the body of their responses, or the first error response"""
+    session = request.app['session']
+
+    async def send(shard, body):
+        url = shard + path
+        async with session.request(method, url, json=body) as response:
+            return response, await response.read()
+
+    shards = request.app['shards']
+    responses = await asyncio.gather(*(send(*item) for item in zip(shards, bodies)))
+    for response, body in responses:
+        if response.status != 200:
+            return error(response, body)
+    return [body for _, body in responses]
+
+
+async def forward(request, uid):
+    """Pass `request` as is to the shard owning `uid`"""
+    url = shard_of(request, uid) + request.path_qs
+    session = request.app['session']
+    data = await request.read()
+    kwargs = dict(data=data, headers=headers_of(request))
+    async with session.request(request.method, url, **kwargs) as response:
+        body = await response.read()
+        headers = dict()
+        if 'ETag' in response.headers:
+            headers['ETag'] = response.headers['ETag']
+        if response.status == 304:
+            return web.Response(status=304, headers=headers)
+        if response.status != 200:
+            return error(response, body)
+        return web.Response(body=body, content_type=response.content_type, headers=headers)
+
+
+async def index(request):
+    kwargs = await request_to_kwargs(request)
+    if kwargs.get('$limit') is not None:
+        return await page(request, kwargs)
+    if NDJSON in request.headers.get('Accept', ''):
+        return await stream(request, kwargs)
+    bodies = await scatter(request, 'GET', '/', [kwargs] * len(request.app['shards']))
+    if isinstance(bodies, web.Response):
+        return bodies
+    return merge_objects(bodies)
+
+
+async def page(request, kwargs):
+    """Fill a page from the shards one after the other, the cursor is
+    the shard being paginated and its own cursor"""
+    shards = request.app['shards']
+    session = request.app['session']
+    try:
+        limit = int(kwargs['$limit'])
+    except (TypeError, ValueError):
+        msg = '$limit must be an integer'
+        raise web.HTTPBadRequest(reason=msg)
+    if limit < 1:
+        msg = '$limit must be positive'
+        raise web.HTTPBadRequest(reason=msg)
+    cursor = kwargs.pop('$cursor', None)
+    if cursor is None:
+        shard = 0
+    else:
+        try:
+            shard, cursor = unpack(urlsafe_b64decode(cursor))
+        except Exception:
+            raise web.HTTPBadRequest(reason='Invalid cursor')
+    items = dict()
+    while shard < len(shards):
+        kwargs['$limit'] = limit - len(items)
+        kwargs['$cursor'] = cursor
+        async with session.get(shards[shard], json=kwargs) as response:
+            body = await response.read()
+            if response.status != 200:
+                return error(response, body)
+            items.update(json.loads(body))
+            cursor = response.headers.get(CURSOR)
+        if cursor is not None:
+            break  # the page is full
+        shard += 1
+    headers = dict()
+    if shard < len(shards):
+        headers[CURSOR] = urlsafe_b64encode(pack((shard, cursor))).decode('ascii')
+    if NDJSON in request.headers.get('Accept', ''):
+        lines = ''.join('[{}, {}]\n'.format(uid, json.dumps(doc)) for uid, doc in items.items())
+        return web.Response(body=lines.encode('utf-8'), content_type=NDJSON, headers=headers)
+    return web.json_response(items, headers=headers)
+
+
+async def stream(request, kwargs):
+    """Write the lines of every shard as they arrive"""
+    session = request.app['session']
+    headers = dict(Accept=NDJSON)
+    async with AsyncExitStack() as stack:
+        # every shard must accept the query before anything is sent
+        upstreams = await asyncio.gather(*(
+            stack.enter_async_context(session.get(shard, json=kwargs, headers=headers))
+            for shard in request.app['shards']
+        ))
+        for upstream in upstreams:
+            if upstream.status != 200:
+                return error(upstream, await upstream.read())
+        response = web.StreamResponse()
+        response.content_type = NDJSON
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        async def pipe(upstream):
+            async for line in upstream.content:
+                await response.write(line)
+
+        await asyncio.gather(*(pipe(upstream) for upstream in upstreams))
+    await response.write_eof()
+    return response
+
+
+async def create(request):
+    # spread the new documents over the shards, the number of a shard
+    # is congruent to the uids it owns
+    return await forward(request, next(request.app['next']))
+
+
+async def bulk(request):
+    """Send the lines of the NDJSON body to the shards a chunk at a time
+    and stream back their results in order"""
+    shards = request.app['shards']
+    session = request.app['session']
+    response = web.StreamResponse()
+    response.content_type = NDJSON
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    async def send(shard, lines):
+        url = shard + '/_bulk'
+        async with session.post(url, data=b''.join(lines)) as upstream:
+            return await upstream.read()
+
+    # keep a chunk in flight per shard
+    pending = list()
+    lines = list()
+    async for line in request.content:
+        if not line.strip():
+            continue
+        lines.append(line if line.endswith(b'\n') else line + b'\n')
+        if len(lines) == BULK_CHUNK_SIZE:
+            shard = shards[len(pending) % len(shards)]
+            pending.append(asyncio.ensure_future(send(shard, lines)))
+            lines = list()
+            if len(pending) == len(shards):
+                for task in pending:
+                    await response.write(await task)
+                pending = list()
+    if lines:
+        shard = shards[len(pending) % len(shards)]
+        pending.append(asyncio.ensure_future(send(shard, lines)))
+    for task in pending:
+        await response.write(await task)
+    await response.write_eof()
+    return response
+
+
+async def mget(request):
+    shards = request.app['shards']
+    try:
+        uids = await request.json()
+    except ValueError:
+        uids = None
+    if not isinstance(uids, list) or not all(isinstance(uid, int) for uid in uids):
+        msg = 'Body must be a JSON encoded array of integers'
+        raise web.HTTPBadRequest(reason=msg)
+    bodies = [list() for _ in shards]
+    for uid in uids:
+        bodies[uid % len(shards)].append(uid)
+    bodies = await scatter(request, 'POST', '/_mget', bodies)
+    if isinstance(bodies, web.Response):
+        return bodies
+    return merge_objects(bodies)
+
+
+async def count(request):
+    kwargs = await request_to_kwargs(request)
+    bodies = await scatter(request, 'GET', '/_count', [kwargs] * len(request.app['shards']))
+    if isinstance(bodies, web.Response):
+        return bodies
+    total = sum(json.loads(body)['count'] for body in bodies)
+    return web.json_response(dict(count=total))
+
+
+async def group(request, path):
+    """Sum the `[value, count]` pairs of every shard in index order"""
+    bodies = await scatter(request, 'GET', path, [None] * len(request.app['shards']))
+    if isinstance(bodies, web.Response):
+        return bodies
+    counts = dict()
+    for body in bodies:
+        for value, total in json.loads(body):
+            key = pack((value,))
+            counts[key] = (value, counts.get(key, (None, 0))[1] + total)
+    return [counts[key] for key in sorted(counts)]
+
+
+async def distinct(request):
+    counts = await group(request, '/_group/' + quote(request.match_info['key'], safe=''))
+    if isinstance(counts, web.Response):
+        return counts
+    return web.json_response([value for value, _ in counts])
+
+
+async def group_by(request):
+    counts = await group(request, '/_group/' + quote(request.match_info['key'], safe=''))
+    if isinstance(counts, web.Response):
+        return counts
+    return web.json_response(counts)
+
+
+async def changes(request):
+    """Return the changes of the shards after `since`, the comma
+    separated sequence numbers of every shard, as soon as one has some"""
+    shards = request.app['shards']
+    session = request.app['session']
+    since = request.query.get('since')
+    try:
+        since = [0] * len(shards) if since is None else [int(x) for x in since.split(',')]
+    except ValueError:
+        since = None
+    if since is None or len(since) != len(shards):
+        msg = 'since must be the sequence numbers of the {} shards'.format(len(shards))
+        raise web.HTTPBadRequest(reason=msg)
+    try:
+        limit = int(request.query.get('limit', 1))
+    except ValueError:
+        limit = None
+    if limit is None or limit < 1:
+        msg = 'limit must be a positive integer'
+        raise web.HTTPBadRequest(reason=msg)
+
+    async def poll(shard, sequence, timeout):
+        params = dict(request.query, since=str(sequence))
+        if timeout is not None:
+            params['timeout'] = timeout
+        async with session.get(shard + '/_changes', params=params) as response:
+            return response, await response.read()
+
+    # look for the changes that are already there...
+    polls = [poll(shard, sequence, '0') for shard, sequence in zip(shards, since)]
+    responses = await asyncio.gather(*polls)
+    found = any(
+        response.status == 200 and json.loads(body)['changes'] for response, body in responses
+    )
+    if not found:
+        # ... otherwise wait for the first shard that has some
+        tasks = [
+            asyncio.ensure_future(poll(shard, sequence, None))
+            for shard, sequence in zip(shards, since)
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        responses = [task.result() if task in done else None for task in tasks]
+    items = list()
+    for position, item in enumerate(responses):
+        if item is None:
+            continue
+        response, body = item
+        if response.status != 200:
+            return error(response, body)
+        out = json.loads(body)
+        items.extend(out['changes'])
+        since[position] = out['last']
+    last = ','.join(str(sequence) for sequence in since)
+    return web.json_response(dict(changes=items, last=last))
+
+
+async def indexes(request, bodies=None):
+    if bodies is None:
+        bodies = await scatter(request, 'GET', '/_indexes', [None] * len(request.app['shards']))
+        if isinstance(bodies, web.Response):
+            return bodies
+    configs = [json.loads(body) for body in bodies]
+    config = configs[0]
+    config['built'] = all(config['built'] for config in configs)
+    return web.json_response(config)
+
+
+async def configure(request):
+    try:
+        config = await request.json()
+    except ValueError:
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    bodies = await scatter(request, 'PUT', '/_indexes', [config] * len(request.app['shards']))
+    if isinstance(bodies, web.Response):
+        return bodies
+    return await indexes(request, bodies)
+
+
+async def document(request):
+    uid = request.match_info['uid']
+    try:
+        uid = int(uid)
+    except ValueError:
+        msg = 'Parameter must be an integer'
+        raise web.HTTPBadRequest(reason=msg)
+    return await forward(request, uid)
+
+
+async def on_startup(app):
+    app['session'] = aiohttp.ClientSession()
+
+
+async def on_cleanup(app):
+    await app['session'].close()
+
+
+def make_router(shards):
+    """Create the application routing the requests to the `shards`, a
+    list of urls, the uids of the shard `n` are congruent to `n` modulo
+    the number of shards"""
+    app = web.Application()
+    app['shards'] = shards
+    app['next'] = cycle(range(len(shards)))
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.add_routes([web.get('/', index)])
+    app.add_routes([web.post('/', create)])
+    app.add_routes([web.get('/_count', count)])
+    app.add_routes([web.get('/_distinct/{key}', distinct)])
+    app.add_routes([web.get('/_group/{key}', group_by)])
+    app.add_routes([web.get('/_changes', changes)])
+    app.add_routes([web.get('/_indexes', indexes)])
+    app.add_routes([web.put('/_indexes', configure)])
+    app.add_routes([web.post('/_mget', mget)])
+    app.add_routes([web.post('/_bulk', bulk)])
+    app.add_routes([web.get('/{uid}', document)])
+    app.add_routes([web.post('/{uid}', document)])
+    app.add_routes([web.patch('/{uid}', document)])
+    app.add_routes([web.delete('/{uid}', document)])
+    return app
+
+
+def serve(path, port, kwargs):
+    """Run a shard, in its own process"""
+    daiquiri.setup(level=logging.INFO)
+    path.mkdir(exist_ok=True)
+    app = make_app(str(path), **kwargs)
+    web.run_app(app, host='127.0.0.1', port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sharded deuspy database server')
+    parser.add_argument('--port', type=int, default=9990)
+    parser.add_argument(
+        '--shards', type=int, required=True,
+        help='number of shard processes, they listen on the ports following --port',
+    )
+    arguments(parser)
+    args = parser.parse_args()
+    daiquiri.setup(level=logging.DEBUG)
+    cwd = Path('.').resolve()
+    shards = list()
+    processes = list()
+    for shard in range(args.shards):
+        port = args.port + 1 + shard
+        kwargs = dict(app_kwargs(args), shard=shard, shards=args.shards)
+        process = Process(target=serve, args=(cwd / 'shard-{}'.format(shard), port, kwargs))
+        process.start()
+        processes.append(process)
+        shards.append('http://127.0.0.1:{}'.format(port))
+    try:
+        web.run_app(make_router(shards), port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,391 @@
+import argparse
+import asyncio
 import json
 import logging
 
 import daiquiri
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+from itertools import islice
 from json.decoder import JSONDecodeError
 from pathlib import Path
 from aiohttp import web
 
 
+from deuspy.base import DeuspyConflict
+from deuspy.base import DeuspyException
 from deuspy.core import Deuspy
+from deuspy.groupcommit import GroupCommit
+from deuspy.metrics import Metrics
 
 
 ROOT = Path(__file__).parent.resolve()
 
+log = daiquiri.getLogger(__name__)
+
+NDJSON = 'application/x-ndjson'
+# the response header holding the cursor of the next page
+CURSOR = 'Deuspy-Cursor'
+# the number of documents read by a storage thread before yielding to the loop
+SCAN_CHUNK_SIZE = 128
+# the number of documents created per batch by the bulk import
+BULK_CHUNK_SIZE = 1000
+# the maximum number of changes per response
+CHANGES_LIMIT = 1000
+# the default number of seconds a request for changes waits for one
+CHANGES_TIMEOUT = 30
+# the content type of the Prometheus text format
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+# the handlers left out of the latency histogram, long-polls mostly wait
+UNTIMED = ('changes',)
+
 
 def pk(*args):
     print(args)
     return args[-1]
 
 
-async def index(request):
-    deuspy = request.app['deuspy']
+def query_to_kwargs(query):
+    """Translate a query string into `Deuspy.query` keyword arguments.
+
+    `?title=deuspy` is an equality predicate, operators are spelled
+    `?popularity.$gt=100` and their operand is decoded as JSON if
+    possible, so that `100` is an integer.
+
+    """
+    kwargs = dict()
+    for key, value in query.items():
+        key, dot, operator = key.partition('.')
+        if dot and operator.startswith('$'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+            kwargs.setdefault(key, dict())[operator] = value
+        else:
+            kwargs[key + dot + operator] = value
+    return kwargs
+
+
+async def run(request, func, *args):
+    """Run the blocking `func` in the storage thread pool"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(request.app['executor'], func, *args)
+
+
+def fetch(deuspy, uids, fields=None):
+    """Read the JSON encoded documents of the next chunk of `uids`, only
+    their `fields` if it is not `None`"""
+    uids = islice(uids, SCAN_CHUNK_SIZE)
+    if fields is None:
+        return deuspy.read_many_json(uids)
+    docs = sorted(deuspy.read_many(uids).items())
+    docs = [(uid, {field: doc[field] for field in fields if field in doc}) for uid, doc in docs]
+    return [(uid, json.dumps(doc).encode('utf-8')) for uid, doc in docs]
+
+
+def fetch_selected(items):
+    """JSON encode the next chunk of the `(uid, doc)` `items`"""
+    items = islice(items, SCAN_CHUNK_SIZE)
+    return [(uid, json.dumps(doc).encode('utf-8')) for uid, doc in items]
+
+
+def query(deuspy, kwargs, limit, cursor, fields):
+    """Return a function that reads the next chunk of results and the
+    cursor of the next page"""
+    if limit is None:
+        if fields is not None:
+            # covering indexes might answer without reading the documents
+            return partial(fetch_selected, deuspy.select(kwargs, fields)), None
+        uids, cursor = deuspy.query(**kwargs), None
+    else:
+        uids, cursor = deuspy.page(kwargs, limit, cursor)
+    return partial(fetch, deuspy, iter(uids), fields), cursor
+
+
+async def request_to_kwargs(request):
+    """Read the query of `request` from its JSON body or its query
+    string"""
     data = await request.read()
-    if data:
+    if not data:
+        return query_to_kwargs(request.query)
+    try:
         kwargs = json.loads(data)
-    else:
-        kwargs = dict(request.query)
-    uids = deuspy.query(**kwargs)
-    everything = {uid: deuspy.read(uid) for uid in uids}
-    return web.json_response(everything)
+    except ValueError:
+        kwargs = None
+    if not isinstance(kwargs, dict):
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    return kwargs
 
 
-async def create(request):
+async def index(request):
     deuspy = request.app['deuspy']
+    kwargs = await request_to_kwargs(request)
+    # pagination and projection parameters are not predicates
+    limit = kwargs.pop('$limit', None)
+    cursor = kwargs.pop('$cursor', None)
+    fields = kwargs.pop('$fields', None)
+    headers = dict()
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            msg = '$limit must be an integer'
+            raise web.HTTPBadRequest(reason=msg)
+        if limit < 1:
+            msg = '$limit must be positive'
+            raise web.HTTPBadRequest(reason=msg)
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    if fields is not None and not all(isinstance(field, str) for field in fields):
+        msg = '$fields must be a list of field names'
+        raise web.HTTPBadRequest(reason=msg)
+    try:
+        chunk, cursor = await run(request, query, deuspy, kwargs, limit, cursor, fields)
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    if cursor is not None:
+        headers[CURSOR] = cursor
+    if NDJSON in request.headers.get('Accept', ''):
+        return await stream(request, chunk, headers)
+    # scan in chunks, so that other requests are served meanwhile
+    everything = list()
+    while True:
+        items = await run(request, chunk)
+        if not items:
+            break
+        everything.extend(items)
+    return json_object_response(everything, headers)
+
+
+def json_object_response(items, headers=None):
+    """Assemble a JSON object out of `(uid, JSON encoded document)` pairs"""
+    body = b'{' + b', '.join(b'"%d": %s' % item for item in items) + b'}'
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def mget(request):
+    try:
+        uids = await request.json()
+    except JSONDecodeError:
+        msg = 'Body must be a JSON encoded array of integers'
+        raise web.HTTPBadRequest(reason=msg)
+    if not isinstance(uids, list) or not all(isinstance(uid, int) for uid in uids):
+        msg = 'Body must be a JSON encoded array of integers'
+        raise web.HTTPBadRequest(reason=msg)
+    deuspy = request.app['deuspy']
+    items = await run(request, deuspy.read_many_json, uids)
+    return json_object_response(items)
+
+
+async def stream(request, chunk, headers):
+    """Write `[uid, doc]` pairs one per line as `chunk` reads them"""
+    response = web.StreamResponse(headers=headers)
+    response.content_type = NDJSON
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    while True:
+        items = await run(request, chunk)
+        if not items:
+            break
+        lines = b''.join(b'[%d, %s]\n' % item for item in items)
+        await response.write(lines)
+    await response.write_eof()
+    return response
+
+
+async def create(request):
     try:
         doc = await request.json()
     except JSONDecodeError:
         msg = 'Body must be a JSON encoded JSObject'
         raise web.HTTPBadRequest(reason=msg)
-    uid = deuspy.create(doc)
+    uid = await request.app['commit'].submit('create', doc)
     return web.json_response(uid)
 
 
+def bulk_create(deuspy, docs, sync):
+    operations = [('create', (doc,)) for doc in docs]
+    return deuspy.apply(operations, sync)
+
+
+async def bulk(request):
+    """Create the documents of the NDJSON body as it is received, and
+    stream back a line per document with its uid or an error"""
+    deuspy = request.app['deuspy']
+    # chunks are already big batches, they skip the group commit but
+    # are as durable as the other writes
+    sync = request.app['commit'].sync
+    response = web.StreamResponse()
+    response.content_type = NDJSON
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    async def flush(docs, errors):
+        # `errors` maps the position of invalid lines to their error
+        results = iter(await run(request, bulk_create, deuspy, docs, sync) if docs else [])
+        lines = list()
+        for position in range(len(docs) + len(errors)):
+            try:
+                result = errors[position]
+            except KeyError:
+                result = next(results)
+            if isinstance(result, Exception):
+                result = dict(error=str(result))
+            lines.append(json.dumps(result) + '\n')
+        await response.write(''.join(lines).encode('utf-8'))
+
+    docs = list()
+    errors = dict()
+    async for line in request.content:
+        if not line.strip():
+            continue
+        try:
+            doc = json.loads(line)
+        except ValueError:
+            doc = None
+        if isinstance(doc, dict):
+            docs.append(doc)
+        else:
+            msg = 'Line must be a JSON encoded JSObject'
+            errors[len(docs) + len(errors)] = DeuspyException(msg)
+        if len(docs) + len(errors) == BULK_CHUNK_SIZE:
+            await flush(docs, errors)
+            docs = list()
+            errors = dict()
+    await flush(docs, errors)
+    await response.write_eof()
+    return response
+
+
+async def count(request):
+    deuspy = request.app['deuspy']
+    kwargs = await request_to_kwargs(request)
+    try:
+        count = await run(request, partial(deuspy.count, **kwargs))
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    return web.json_response(dict(count=count))
+
+
+async def distinct(request):
+    deuspy = request.app['deuspy']
+    try:
+        values = await run(request, deuspy.distinct, request.match_info['key'])
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    return web.json_response(values)
+
+
+async def group_by(request):
+    deuspy = request.app['deuspy']
+    try:
+        counts = await run(request, deuspy.group_by, request.match_info['key'])
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    return web.json_response(counts)
+
+
+async def changes(request):
+    """Return the changes after the sequence number `since`, waiting at
+    most `timeout` seconds for one when there is none yet"""
+    try:
+        since = int(request.query.get('since', 0))
+        limit = min(int(request.query.get('limit', CHANGES_LIMIT)), CHANGES_LIMIT)
+        timeout = float(request.query.get('timeout', CHANGES_TIMEOUT))
+    except ValueError:
+        msg = 'since, limit and timeout must be numbers'
+        raise web.HTTPBadRequest(reason=msg)
+    if limit < 1:
+        msg = 'limit must be positive'
+        raise web.HTTPBadRequest(reason=msg)
+    deuspy = request.app['deuspy']
+    condition = request.app['changed']
+    async with condition:
+        if deuspy.sequence() <= since and timeout > 0:
+            try:
+                await asyncio.wait_for(condition.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    items = await run(request, deuspy.changes, since, limit)
+    last = items[-1][0] if items else since
+    return web.json_response(dict(changes=items, last=last))
+
+
+async def notify(condition):
+    async with condition:
+        condition.notify_all()
+
+
+async def indexes(request):
+    deuspy = request.app['deuspy']
+    return web.json_response(deuspy.indexes())
+
+
+def is_names(value):
+    return isinstance(value, list) and all(isinstance(name, str) for name in value)
+
+
+async def configure(request):
+    try:
+        config = await request.json()
+    except JSONDecodeError:
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    if not isinstance(config, dict):
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    fields = config.get('fields')
+    covering = config.get('covering')
+    if fields is not None and not is_names(fields):
+        msg = 'fields must be a list of field names or null'
+        raise web.HTTPBadRequest(reason=msg)
+    if covering is not None and not isinstance(covering, dict):
+        msg = 'covering must be a JSObject or null'
+        raise web.HTTPBadRequest(reason=msg)
+    if covering is not None and not all(is_names(value) for value in covering.values()):
+        msg = 'covering must map fields to lists of field names'
+        raise web.HTTPBadRequest(reason=msg)
+    deuspy = request.app['deuspy']
+    try:
+        await run(request, deuspy.configure, fields, covering)
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    if not deuspy.indexes()['built']:
+        background(request.app, deuspy.backfill, '%s documents indexed')
+    return web.json_response(deuspy.indexes())
+
+
+def etag(version):
+    return '"{}"'.format(version)
+
+
+def if_match(request):
+    """Return the version required by the `If-Match` header or `None`"""
+    value = request.headers.get('If-Match')
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+            raise ValueError()
+        return int(value[1:-1])
+    except ValueError:
+        msg = 'If-Match must be the ETag of the document'
+        raise web.HTTPBadRequest(reason=msg)
+
+
+def if_none_match(request, tag):
+    """Return whether the `If-None-Match` header matches `tag`"""
+    value = request.headers.get('If-None-Match')
+    if value is None:
+        return False
+    tags = [item.strip() for item in value.split(',')]
+    return '*' in tags or tag in tags or 'W/' + tag in tags
+
+
 async def read(request):
     uid = request.match_info['uid']
     try:
@@ -49,11 +394,13 @@ async def read(request):
         msg = 'Parameter must be an integer'
         raise web.HTTPBadRequest(reason=msg)
     deuspy = request.app['deuspy']
-    doc = deuspy.read(uid)
-    if doc is None:
+    body, version = await run(request, deuspy.read_json, uid)
+    if body is None:
         raise web.HTTPNotFound()
-    else:
-        return web.json_response(doc)
+    headers = dict(ETag=etag(version))
+    if if_none_match(request, headers['ETag']):
+        raise web.HTTPNotModified(headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
 
 
 async def update(request):
@@ -71,11 +418,42 @@ async def update(request):
     if not isinstance(doc, dict):
         msg = 'Body must be a JSON encoded JSObject'
         raise web.HTTPBadRequest(reason=msg)
-    deuspy = request.app['deuspy']
-    deuspy.update(uid, doc)
+    version = if_match(request)
+    try:
+        await request.app['commit'].submit('update', uid, doc, version)
+    except DeuspyConflict as exc:
+        raise web.HTTPPreconditionFailed(reason=str(exc))
     return web.json_response()
 
 
+async def patch(request):
+    uid = request.match_info['uid']
+    try:
+        uid = int(uid)
+    except ValueError:
+        msg = 'Parameter must be an integer'
+        raise web.HTTPBadRequest(reason=msg)
+    try:
+        operations = await request.json()
+    except JSONDecodeError:
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    if not isinstance(operations, dict):
+        msg = 'Body must be a JSON encoded JSObject'
+        raise web.HTTPBadRequest(reason=msg)
+    version = if_match(request)
+    try:
+        doc = await request.app['commit'].submit('patch', uid, operations, version)
+    except DeuspyConflict as exc:
+        raise web.HTTPPreconditionFailed(reason=str(exc))
+    except DeuspyException as exc:
+        raise web.HTTPBadRequest(reason=str(exc))
+    if doc is None:
+        raise web.HTTPNotFound()
+    else:
+        return web.json_response(doc)
+
+
 async def delete(request):
     uid = request.match_info['uid']
     try:
@@ -83,24 +461,170 @@ async def delete(request):
     except ValueError:
         msg = 'Parameter must be an integer'
         raise web.HTTPBadRequest(reason=msg)
-    deuspy = request.app['deuspy']
-    if deuspy.delete(uid):
+    version = if_match(request)
+    try:
+        deleted = await request.app['commit'].submit('delete', uid, version)
+    except DeuspyConflict as exc:
+        raise web.HTTPPreconditionFailed(reason=str(exc))
+    if deleted:
         return web.json_response()
     else:
         raise web.HTTPNotFound()
 
 
-def main():
-    daiquiri.setup(level=logging.DEBUG)
-    app = web.Application()
-    cwd = str(Path('.').resolve())
-    app['deuspy'] = Deuspy(cwd, create_if_missing=True)
+async def metrics(request):
+    """Return the metrics of the database, of the handlers and of the
+    group commit in the Prometheus text format"""
+    app = request.app
+    text = app['deuspy'].metrics().render() + app['metrics'].render()
+    text += app['commit'].metrics.render()
+    return web.Response(body=text.encode('utf-8'), headers={'Content-Type': PROMETHEUS})
+
+
+@web.middleware
+async def timing(request, handler):
+    """Observe the duration of every request by handler"""
+    name = getattr(handler, '__name__', 'unknown')
+    if name in UNTIMED:
+        return await handler(request)
+    start = perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        request.app['metrics'].observe(name, perf_counter() - start)
+
+
+def background(app, func, message):
+    """Run `func` in the storage thread pool and log `message` with its
+    result once it is done"""
+    def done(future):
+        if future.exception() is None:
+            log.info(message, future.result())
+        else:
+            log.error('%s failed', func.__name__, exc_info=future.exception())
+
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(app['executor'], func)
+    future.add_done_callback(done)
+
+
+async def on_startup(app):
+    deuspy = app['deuspy']
+    # wake up the requests waiting for changes after every write
+    app['changed'] = condition = asyncio.Condition()
+    loop = asyncio.get_event_loop()
+    deuspy.subscribe(lambda sequence: asyncio.run_coroutine_threadsafe(notify(condition), loop))
+    if app['migrate']:
+        # rewrite the documents in the format of the database meanwhile
+        # the server is running
+        background(app, deuspy.migrate, '%s documents migrated')
+    if not deuspy.indexes()['built']:
+        # resume the build of the index
+        background(app, deuspy.backfill, '%s documents indexed')
+
+
+async def on_cleanup(app):
+    app['executor'].shutdown()
+    app['deuspy'].close()
+
+
+def make_app(path, workers=None, window=0, size=256, sync=False, migrate=False, **options):
+    """Create the application serving the database at `path` with
+    `workers` storage threads. Writes are grouped in batches of at most
+    `size` operations within `window` seconds, see `GroupCommit`. With
+    `migrate` documents in another format are rewritten in the background.
+    Other `options` are passed to `Deuspy`."""
+    app = web.Application(middlewares=[timing])
+    app['metrics'] = Metrics('deuspy_', 'handler')
+    app['deuspy'] = Deuspy(path, create_if_missing=True, **options)
+    app['executor'] = ThreadPoolExecutor(max_workers=workers)
+    app['commit'] = GroupCommit(app['deuspy'], app['executor'], window, size, sync)
+    app['migrate'] = migrate
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     app.add_routes([web.get('/', index)])
     app.add_routes([web.post('/', create)])
+    app.add_routes([web.get('/_count', count)])
+    app.add_routes([web.get('/_distinct/{key}', distinct)])
+    app.add_routes([web.get('/_group/{key}', group_by)])
+    app.add_routes([web.get('/_changes', changes)])
+    app.add_routes([web.get('/_indexes', indexes)])
+    app.add_routes([web.put('/_indexes', configure)])
+    app.add_routes([web.post('/_mget', mget)])
+    app.add_routes([web.post('/_bulk', bulk)])
+    app.add_routes([web.get('/_metrics', metrics)])
     app.add_routes([web.get('/{uid}', read)])
     app.add_routes([web.post('/{uid}', update)])
+    app.add_routes([web.patch('/{uid}', patch)])
     app.add_routes([web.delete('/{uid}', delete)])
-    web.run_app(app, port=9990)
+    return app
+
+
+def arguments(parser):
+    """Add the options of `make_app` to the argparse `parser`"""
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='size of the storage thread pool (default: depends on the number of cores)',
+    )
+    parser.add_argument(
+        '--commit-window', type=float, default=0,
+        help='milliseconds to wait for more writes before committing a batch (default: 0)',
+    )
+    parser.add_argument(
+        '--commit-size', type=int, default=256,
+        help='maximum number of writes in a batch (default: 256)',
+    )
+    parser.add_argument(
+        '--sync', action='store_true',
+        help='wait for every batch to reach the disk before answering',
+    )
+    parser.add_argument(
+        '--cache-entries', type=int, default=None,
+        help='maximum number of documents kept in memory, decoded and JSON encoded, '
+        'so that reading a binary document again over HTTP does not decode it',
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=None,
+        help='maximum size in bytes of the documents kept in memory, see --cache-entries',
+    )
+    parser.add_argument(
+        '--uids', choices=('sequential', 'random'), default='sequential',
+        help='how the uids of new documents are made (default: sequential)',
+    )
+    parser.add_argument(
+        '--format', choices=('binary', 'json'), default='binary',
+        help='format of the documents written on disk, HTTP reads send json documents '
+        'as stored and decode binary ones unless they are cached (default: binary)',
+    )
+    parser.add_argument(
+        '--migrate', action='store_true',
+        help='rewrite the documents stored in another format in the background',
+    )
+    parser.add_argument(
+        '--slow-query', type=float, default=None,
+        help='log the queries that take more than this many milliseconds',
+    )
+
+
+def app_kwargs(args):
+    """Return the keyword arguments of `make_app` parsed by `arguments`"""
+    return dict(
+        workers=args.workers, window=args.commit_window / 1000, size=args.commit_size,
+        sync=args.sync, migrate=args.migrate, cache_entries=args.cache_entries,
+        cache_size=args.cache_size, uids=args.uids, format=args.format,
+        slow_query=None if args.slow_query is None else args.slow_query / 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='deuspy database server')
+    parser.add_argument('--port', type=int, default=9990)
+    arguments(parser)
+    args = parser.parse_args()
+    daiquiri.setup(level=logging.DEBUG)
+    cwd = str(Path('.').resolve())
+    app = make_app(cwd, **app_kwargs(args))
+    web.run_app(app, port=args.port)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,340 @@
+"""Check `Deuspy` against plain Python over the documents it stores"""
+import operator
+import random
+
+import pytest
+
+from deuspy.base import DeuspyConflict
+from deuspy.base import DeuspyException
+from deuspy.core import Deuspy
+
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    rng = random.Random(7)
+    deuspy = Deuspy(str(tmp_path_factory.mktemp('db')), create_if_missing=True)
+    docs = [
+        dict(
+            a=rng.randrange(4), b=rng.randrange(6), c=rng.choice('xyz'), d=rng.randrange(50),
+            rank=rng.choice([rng.randrange(-500, 500), rng.uniform(-500, 500)]),
+        )
+        for _ in range(3000)
+    ]
+    uids = list(deuspy.create_many(docs))
+    # delete some documents, so that the uids have holes
+    for uid in uids[::11]:
+        deuspy.delete(uid)
+    docs = {uid: doc for uid, doc in zip(uids, docs) if deuspy.read(uid) is not None}
+    yield deuspy, docs
+    deuspy.close()
+
+
+@pytest.fixture
+def deuspy(tmp_path):
+    deuspy = Deuspy(str(tmp_path), create_if_missing=True)
+    yield deuspy
+    deuspy.close()
+
+
+COMPARISONS = {
+    '$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le,
+}
+
+
+def compare(value, name, operand):
+    if name == '$prefix':
+        return isinstance(value, str) and value.startswith(operand)
+    elif name == '$between':
+        low, high = operand
+        return compare(value, '$gte', low) and compare(value, '$lte', high)
+    elif isinstance(value, str) != isinstance(operand, str):
+        return False  # strings are not compared with numbers
+    else:
+        return COMPARISONS[name](value, operand)
+
+
+def matches(doc, key, condition):
+    if key not in doc:
+        return False
+    value = doc[key]
+    if not isinstance(condition, dict):
+        # 1 and 1.0 are different values in the index
+        return type(value) is type(condition) and value == condition
+    return all(compare(value, name, operand) for name, operand in condition.items())
+
+
+def expected(docs, query):
+    """Return the sorted uids of the `docs` matching `query`"""
+    return sorted(
+        uid for uid, doc in docs.items()
+        if all(matches(doc, key, condition) for key, condition in query.items())
+    )
+
+
+def paginate(deuspy, query, limit):
+    out = list()
+    cursor = None
+    while True:
+        uids, cursor = deuspy.page(query, limit, cursor)
+        assert len(uids) <= limit
+        out.extend(uids)
+        if cursor is None:
+            return out
+
+
+def paginate_from(deuspy, query, limit, cursor):
+    out = list()
+    while cursor is not None:
+        uids, cursor = deuspy.page(query, limit, cursor)
+        out.extend(uids)
+    return out
+
+
+QUERIES = [
+    dict(),
+    dict(a=1),
+    dict(a=1, b=2),
+    dict(a=0, b=5, c='z'),
+    dict(a=3, rank={'$gt': 0}),
+    dict(rank={'$gte': -100, '$lt': 100.5}),
+    dict(rank={'$between': [-10.5, 10]}, c='x'),
+    dict(rank={'$lte': 250}, a={'$gt': 1}),
+    dict(d=3, rank={'$gt': -400}),
+    dict(c={'$prefix': 'y'}),
+    dict(c={'$gt': 'x', '$lte': 'y'}),
+    dict(a=7),
+]
+
+
+def test_update_and_delete_maintain_the_index(deuspy):
+    uid = deuspy.create(dict(a=1, b=2))
+    deuspy.update(uid, dict(a=2, b=2))
+    assert list(deuspy.query(a=1)) == []
+    assert list(deuspy.query(a=2)) == [uid]
+    assert list(deuspy.query(b=2)) == [uid]
+    deuspy.delete(uid)
+    assert list(deuspy.query(b=2)) == []
+    assert deuspy.read(uid) is None
+
+
+def test_plan_starts_with_the_most_selective_predicate(deuspy):
+    list(deuspy.create_many(dict(kind='x', number=i) for i in range(100)))
+    plan = deuspy.explain(kind='x', number=5)
+    assert plan['predicates'][0] == ['number', 5]
+    assert plan['estimate'] == 1
+    assert deuspy.explain(kind='y', number=5)['estimate'] == 0
+    assert list(deuspy.query(kind='y', number=5)) == []
+
+
+def test_leapfrog_intersection(database):
+    deuspy, docs = database
+    rng = random.Random(8)
+    for _ in range(100):
+        query = dict(a=rng.randrange(5), b=rng.randrange(7), c=rng.choice('xyzw'))
+        query = dict(rng.sample(sorted(query.items()), rng.randrange(2, 4)))
+        assert deuspy.explain(**query)['scan'] == 'intersect'
+        uids = list(deuspy.query(**query))
+        # the intersection yields the uids in order
+        assert uids == expected(docs, query)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query(database, query):
+    deuspy, docs = database
+    assert sorted(deuspy.query(**query)) == expected(docs, query)
+
+
+def test_numbers_match_integers_and_floats(deuspy):
+    uids = list(deuspy.create_many([dict(n=1), dict(n=1.5), dict(n=2), dict(n=2.0), dict(n='2')]))
+    assert sorted(deuspy.query(n={'$gt': 1})) == uids[1:4]
+    assert sorted(deuspy.query(n={'$lte': 1.5})) == uids[:2]
+    assert list(deuspy.query(n=2)) == [uids[2]]
+
+
+@pytest.mark.parametrize('value', [
+    dict(), {'$in': [1]}, {'$between': 1}, {'$prefix': 1}, {'$gt': dict()},
+])
+def test_invalid_predicates(deuspy, value):
+    with pytest.raises(DeuspyException):
+        deuspy.query(a=value)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('limit', [1, 7, 100, 5000])
+def test_pages(database, query, limit):
+    deuspy, docs = database
+    uids = paginate(deuspy, query, limit)
+    assert len(uids) == len(set(uids))
+    assert sorted(uids) == expected(docs, query)
+
+
+def test_pages_resume_without_estimates(database, monkeypatch):
+    deuspy, docs = database
+    query = dict(a=3, rank={'$gt': 0})
+    uids, cursor = deuspy.page(query, 10)
+
+    def estimate(predicate, limit=None):
+        raise AssertionError('the driver of a page is known')
+
+    monkeypatch.setattr(deuspy, 'estimate', estimate)
+    assert sorted(uids + paginate_from(deuspy, query, 10, cursor)) == expected(docs, query)
+    assert len(deuspy.page(dict(rank={'$gt': 0}), 10)[0]) == 10
+
+
+def test_cursor_survives_writes(deuspy):
+    uids = list(deuspy.create_many(dict(a=1, b=i % 2) for i in range(100)))
+    page, cursor = deuspy.page(dict(a=1, b=0), 10)
+    # documents before the cursor are deleted, others are added after it
+    for uid in page:
+        deuspy.delete(uid)
+    extra = deuspy.create(dict(a=1, b=0))
+    rest = paginate_from(deuspy, dict(a=1, b=0), 10, cursor)
+    assert sorted(page + rest) == sorted(uids[::2] + [extra])
+
+
+def test_invalid_pages(database):
+    deuspy, _ = database
+    _, cursor = deuspy.page(dict(a=1), 1)
+    with pytest.raises(DeuspyException):
+        deuspy.page(dict(b=1), 1, cursor)
+    with pytest.raises(DeuspyException):
+        deuspy.page(dict(a=1), 1, 'garbage')
+    with pytest.raises(DeuspyException):
+        deuspy.page(dict(a=1), 0)
+
+
+def test_cache(tmp_path):
+    deuspy = Deuspy(str(tmp_path), create_if_missing=True, cache_entries=10)
+    uid = deuspy.create(dict(a=1, tags=['x']))
+    deuspy.read(uid)['tags'].append('y')
+    assert deuspy.read(uid) == dict(a=1, tags=['x'])
+    assert deuspy.cache_stats()['hits'] == 1
+    # writes invalidate the cached document
+    deuspy.update(uid, dict(a=2))
+    assert deuspy.read(uid) == dict(a=2)
+    deuspy.delete(uid)
+    assert deuspy.read(uid) is None
+    deuspy.close()
+
+
+def test_read_many(deuspy):
+    uids = list(deuspy.create_many(dict(i=i) for i in range(100)))
+    for uid in uids[::3]:
+        deuspy.delete(uid)
+    docs = {uid: dict(i=i) for i, uid in enumerate(uids) if i % 3}
+    # a few uids are read one at a time, many with a single iterator
+    for wanted in (uids[:10], uids):
+        out = deuspy.read_many(wanted + [max(uids) + 1])
+        assert out == {uid: docs[uid] for uid in wanted if uid in docs}
+
+
+def test_patch(deuspy):
+    uid = deuspy.create(dict(a=1, b=2, n=1))
+    doc = deuspy.patch(uid, {'$set': dict(a=3), '$unset': ['b'], '$inc': dict(n=2.5)})
+    assert doc == dict(a=3, n=3.5)
+    assert deuspy.read(uid) == doc
+    assert list(deuspy.query(a=3)) == [uid]
+    assert list(deuspy.query(b=2)) == []
+    assert deuspy.patch(uid + 1, {'$set': dict(a=1)}) is None
+    for operations in ({'$push': dict(a=1)}, {'$inc': dict(a='x')}, {'$set': ['a']}):
+        with pytest.raises(DeuspyException):
+            deuspy.patch(uid, operations)
+    assert deuspy.read(uid) == doc
+
+
+def test_backfill(deuspy):
+    docs = [dict(a=i % 3, b=i, c=[dict(d=i)]) for i in range(50)]
+    uids = list(deuspy.create_many(docs))
+    deuspy.configure(fields=['a'], covering=dict(a=['b']))
+    assert not deuspy.indexes()['built']
+    # documents written meanwhile are indexed once
+    docs.append(dict(a=1, b=50))
+    uids.append(deuspy.create(docs[-1]))
+    assert deuspy.backfill(size=7) == 51
+    assert deuspy.indexes()['built']
+    assert deuspy.explain(a=1)['scan'] == 'index'
+    assert deuspy.explain(b=1)['scan'] == 'docs'
+    assert sorted(deuspy.query(a=1)) == [uid for uid, doc in zip(uids, docs) if doc['a'] == 1]
+    selected = dict(deuspy.select(dict(a=2), ['a', 'b']))
+    assert selected == {
+        uid: dict(a=2, b=doc['b']) for uid, doc in zip(uids, docs) if doc['a'] == 2
+    }
+    with pytest.raises(DeuspyException):
+        deuspy.count(b=1)
+
+
+@pytest.mark.parametrize('fields, covering', [
+    ([1], None), (['a'], dict(a='b')), (['a'], dict(b=['a'])),
+])
+def test_invalid_configuration(deuspy, fields, covering):
+    with pytest.raises(DeuspyException):
+        deuspy.configure(fields, covering)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_count(database, query, monkeypatch):
+    deuspy, docs = database
+
+    def read(uid):
+        raise AssertionError('count read a document')
+
+    monkeypatch.setattr(deuspy, '_read', read)
+    assert deuspy.count(**query) == len(expected(docs, query))
+
+
+def test_distinct_and_group_by(database):
+    deuspy, docs = database
+    for key in ('a', 'c'):
+        counts = dict()
+        for doc in docs.values():
+            counts[doc[key]] = counts.get(doc[key], 0) + 1
+        assert deuspy.group_by(key) == sorted(counts.items())
+        assert deuspy.distinct(key) == sorted(counts)
+
+
+def test_changes(tmp_path):
+    deuspy = Deuspy(str(tmp_path), create_if_missing=True)
+    uid = deuspy.create(dict(a=1))
+    deuspy.patch(uid, {'$set': dict(a=2)})
+    deuspy.delete(uid)
+    changes = [(1, 'create', uid), (2, 'patch', uid), (3, 'delete', uid)]
+    assert deuspy.changes() == changes
+    assert deuspy.changes(1, 1) == changes[1:2]
+    deuspy.close()
+    # the sequence goes on after a restart
+    deuspy = Deuspy(str(tmp_path))
+    assert deuspy.sequence() == 3
+    other = deuspy.create(dict(a=1))
+    assert deuspy.changes(3) == [(4, 'create', other)]
+    deuspy.close()
+
+
+def test_versions(deuspy):
+    uid = deuspy.create(dict(a=1))
+    value, version = deuspy.read_versioned(uid)
+    assert version > 0
+    deuspy.update(uid, dict(a=2), version)
+    for write in (
+            lambda: deuspy.update(uid, dict(a=3), version),
+            lambda: deuspy.patch(uid, {'$set': dict(a=3)}, version),
+            lambda: deuspy.delete(uid, version),
+    ):
+        with pytest.raises(DeuspyConflict):
+            write()
+    assert deuspy.read(uid) == dict(a=2)
+    _, version = deuspy.read_versioned(uid)
+    deuspy.patch(uid, {'$set': dict(a=3)}, version)
+    assert deuspy.read_versioned(uid + 1) == (None, None)
+
+
+def test_metrics(deuspy):
+    uids = list(deuspy.create_many(dict(a=i % 2) for i in range(100)))
+    deuspy.read(uids[0])
+    deuspy.read_many(uids)
+    list(deuspy.query(a=1))
+    metrics = deuspy.metrics()
+    assert metrics.count('point_gets') >= 1
+    assert metrics.count('seeks') == len(uids)
+    assert metrics.count('index_keys_scanned') == 50
+    text = metrics.render()
+    assert 'deuspy_operation_seconds_count{operation="query"} 1' in text
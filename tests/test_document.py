@@ -0,0 +1,46 @@
+"""Check the formats of the stored documents"""
+import pickle
+
+import pytest
+
+from deuspy import document
+from deuspy.base import DeuspyException
+from deuspy.core import Deuspy
+
+
+DOC = dict(title='deuspy', popularity=1, score=0.5, tags=['a', None], nested=dict(ok=True))
+
+
+@pytest.mark.parametrize('format', document.FORMATS)
+def test_round_trip(format):
+    value = document.dumps(DOC, format)
+    assert document.format_of(value) == format
+    assert document.loads(value) == DOC
+    assert document.loads(document.to_json(value)) == DOC
+
+
+def test_json_is_passed_through():
+    value = document.dumps(DOC, 'json')
+    assert document.to_json(value) is value
+
+
+def test_classes_are_refused():
+    value = bytes((document.PICKLE_V4,)) + pickle.dumps(Exception('boom'), 4)
+    with pytest.raises(DeuspyException):
+        document.loads(value)
+    with pytest.raises(DeuspyException):
+        document.loads(b'\x7fnope')
+
+
+def test_migrate(tmp_path):
+    deuspy = Deuspy(str(tmp_path), create_if_missing=True, format='json')
+    uids = list(deuspy.create_many(dict(i=i) for i in range(10)))
+    deuspy.close()
+    # both formats are read while the documents are rewritten
+    deuspy = Deuspy(str(tmp_path))
+    uids.append(deuspy.create(dict(i=10)))
+    assert [deuspy.read(uid) for uid in uids] == [dict(i=i) for i in range(11)]
+    assert deuspy.migrate(size=3) == 10
+    assert deuspy.migrate() == 0
+    assert [deuspy.read(uid) for uid in uids] == [dict(i=i) for i in range(11)]
+    deuspy.close()
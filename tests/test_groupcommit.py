@@ -0,0 +1,54 @@
+"""Check that `GroupCommit` batches the writes and answers each of them"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from deuspy.base import DeuspyException
+from deuspy.core import Deuspy
+from deuspy.groupcommit import GroupCommit
+
+
+@pytest.fixture
+def deuspy(tmp_path):
+    deuspy = Deuspy(str(tmp_path), create_if_missing=True)
+    yield deuspy
+    deuspy.close()
+
+
+def submit(commit, operations):
+    """Submit every of `operations` at once and return their results or
+    their exception"""
+    async def main():
+        futures = [commit.submit(name, *args) for name, args in operations]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    return asyncio.run(main())
+
+
+def test_writes_are_grouped(deuspy):
+    with ThreadPoolExecutor(2) as executor:
+        commit = GroupCommit(deuspy, executor, window=0.01, size=8)
+        uids = submit(commit, [('create', (dict(i=i),)) for i in range(20)])
+    assert [deuspy.read(uid) for uid in uids] == [dict(i=i) for i in range(20)]
+    # the first batch is full, the others wait for it
+    text = commit.metrics.render()
+    assert 'deuspy_commit_operations_bucket{commit="batch",le="8.0"} 3' in text
+    assert 'deuspy_commit_operations_count{commit="batch"} 3' in text
+
+
+def test_failures_are_answered_one_by_one(deuspy):
+    uid = deuspy.create(dict(n=1))
+    operations = [
+        ('patch', (uid, {'$inc': dict(n=1)})),
+        ('patch', (uid, {'$inc': dict(n='x')})),
+        ('delete', (uid + 1,)),
+        ('patch', (uid, {'$inc': dict(n=1)})),
+    ]
+    with ThreadPoolExecutor(2) as executor:
+        commit = GroupCommit(deuspy, executor, window=0.01)
+        results = submit(commit, operations)
+    assert results[0] == dict(n=2)
+    assert isinstance(results[1], DeuspyException)
+    assert results[2:] == [False, dict(n=3)]
+    assert 'deuspy_commit_operations_count{commit="batch"} 1' in commit.metrics.render()
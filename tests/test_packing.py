@@ -0,0 +1,117 @@
+"""Check the table-driven codec against the reference `_encode` and
+`_decode` codec"""
+import random
+import uuid
+
+from deuspy import packing
+
+
+# the integers around the boundaries of the number of bytes
+BOUNDARIES = [
+    sign * ((1 << (8 * n)) + delta)
+    for n in range(10) for delta in (-2, -1, 0, 1) for sign in (1, -1)
+]
+STRINGS = ['', 'a', 'deuspy', 'é', '\x00', 'a\x00b', '\x00\xff', 'z' * 300]
+
+
+def reference_pack(t, prefix=None):
+    return packing._pack_maybe_with_versionstamp(t, prefix)[0]
+
+
+def reference_unpack(key, prefix_len=0):
+    pos = prefix_len
+    out = []
+    while pos < len(key):
+        value, pos = packing._decode(key, pos)
+        out.append(value)
+    return tuple(out)
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(9 if depth < 2 else 8)
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return rng.choice(BOUNDARIES)
+    elif kind == 2:
+        return rng.randint(-(1 << 70), 1 << 70)
+    elif kind == 3:
+        return rng.choice([0.0, -0.0, 1.5, -1.5, 1e300, -1e-300, rng.uniform(-1e6, 1e6)])
+    elif kind == 4:
+        return rng.choice(STRINGS) + str(rng.randrange(100))
+    elif kind == 5:
+        return rng.choice([b'', b'\x00', b'\x00\xff', bytes(rng.randrange(256) for _ in range(5))])
+    elif kind == 6:
+        return rng.choice([True, False])
+    elif kind == 7:
+        return uuid.UUID(int=rng.getrandbits(128))
+    else:
+        return tuple(random_value(rng, depth + 1) for _ in range(rng.randrange(4)))
+
+
+def random_tuples(count, seed=42):
+    rng = random.Random(seed)
+    return [tuple(random_value(rng) for _ in range(rng.randrange(1, 5))) for _ in range(count)]
+
+
+def test_pack_matches_reference():
+    for t in random_tuples(5000):
+        assert packing.pack(t) == reference_pack(t), t
+        assert packing.pack(t, prefix=b'docs:') == reference_pack(t, prefix=b'docs:'), t
+
+
+def test_unpack_matches_reference():
+    for t in random_tuples(5000):
+        key = reference_pack(t, prefix=b'index:')
+        assert packing.unpack(key, 6) == reference_unpack(key, 6), t
+        assert packing.unpack(key, 6) == t
+
+
+def test_lists_pack_like_tuples():
+    assert packing.pack(([1, 'a', None],)) == reference_pack(((1, 'a', None),))
+
+
+def test_skip_and_unpack_at():
+    for t in random_tuples(2000):
+        key = packing.pack(t)
+        pos = 0
+        for index, value in enumerate(t):
+            assert packing.unpack_element(key, index) == value
+            element, end = packing.unpack_at(key, pos)
+            assert element == value
+            assert packing.skip(key, pos) == end
+            pos = end
+        assert pos == len(key)
+        assert packing.skip(key, 0, len(t)) == len(key)
+
+
+def test_order_of_integers():
+    rng = random.Random(1)
+    values = BOUNDARIES + [rng.randint(-(1 << 80), 1 << 80) for _ in range(2000)]
+    values = sorted(set(values))
+    assert sorted(values, key=lambda v: packing.pack((v,))) == values
+
+
+def test_order_of_floats():
+    rng = random.Random(2)
+    values = [-1e300, -1.5, -1e-300, 0.0, 1e-300, 1.5, 1e300]
+    values += [rng.uniform(-1e9, 1e9) for _ in range(2000)]
+    values = sorted(set(values))
+    assert sorted(values, key=lambda v: packing.pack((v,))) == values
+
+
+def test_order_of_strings():
+    rng = random.Random(3)
+    alphabet = ['a', 'b', '\x00', 'é', '￿']
+    values = {''.join(rng.choice(alphabet) for _ in range(rng.randrange(6))) for _ in range(2000)}
+    values = sorted(values, key=lambda v: v.encode('utf-8'))
+    assert sorted(values, key=lambda v: packing.pack((v,))) == values
+
+
+def test_order_of_tuples():
+    rng = random.Random(4)
+    values = {
+        ('title', rng.choice(STRINGS), rng.randrange(-1000, 1000)) for _ in range(2000)
+    }
+    values = sorted(values, key=lambda v: (v[0], v[1].encode('utf-8'), v[2]))
+    assert sorted(values, key=packing.pack) == values
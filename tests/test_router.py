@@ -0,0 +1,116 @@
+"""Check `deuspy.router` in front of shards served in the same process"""
+import asyncio
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from deuspy.router import make_router
+from deuspy.server import CURSOR
+from deuspy.server import make_app
+
+
+SHARDS = 3
+
+
+def route(path, test):
+    """Run the coroutine function `test` with a client of a router in
+    front of `SHARDS` shards whose databases are in `path`"""
+    async def main():
+        servers = list()
+        for shard in range(SHARDS):
+            app = make_app(str(path / str(shard)), shard=shard, shards=SHARDS)
+            server = TestServer(app, host='127.0.0.1')
+            await server.start_server()
+            servers.append(server)
+        try:
+            urls = ['http://127.0.0.1:{}'.format(server.port) for server in servers]
+            async with TestClient(TestServer(make_router(urls))) as client:
+                await test(client, servers)
+        finally:
+            for server in servers:
+                await server.close()
+
+    asyncio.run(main())
+
+
+async def create(client, doc):
+    response = await client.post('/', json=doc)
+    assert response.status == 200
+    return await response.json()
+
+
+def test_documents_go_to_their_shard(tmp_path):
+    async def test(client, servers):
+        uids = [await create(client, dict(i=i)) for i in range(6)]
+        assert sorted(uid % SHARDS for uid in uids) == sorted(list(range(SHARDS)) * 2)
+        for uid in uids:
+            # the shard holds the document...
+            deuspy = servers[uid % SHARDS].app['deuspy']
+            assert deuspy.read(uid) is not None
+        # ... and the router sends the requests there
+        url = '/{}'.format(uids[0])
+        response = await client.get(url)
+        assert await response.json() == dict(i=0)
+        etag = response.headers['ETag']
+        response = await client.get(url, headers={'If-None-Match': etag})
+        assert response.status == 304
+        response = await client.patch(url, json={'$set': dict(i=10)}, headers={'If-Match': etag})
+        assert await response.json() == dict(i=10)
+        assert (await client.delete(url, headers={'If-Match': etag})).status == 412
+        assert (await client.delete(url)).status == 200
+        assert (await client.get(url)).status == 404
+        response = await client.post('/_mget', json=uids)
+        assert await response.json() == {str(uid): dict(i=i) for i, uid in enumerate(uids) if i}
+
+    route(tmp_path, test)
+
+
+def test_queries_are_scattered(tmp_path):
+    async def test(client, servers):
+        uids = [await create(client, {'a/b': i % 2, 'i': i}) for i in range(20)]
+        response = await client.get('/', json={'a/b': 1})
+        assert sorted(map(int, await response.json())) == sorted(uids[1::2])
+        out = dict()
+        query = {'a/b': 0, '$limit': 3}
+        while True:
+            response = await client.get('/', json=query)
+            assert response.status == 200
+            page = await response.json()
+            assert len(page) <= 3
+            out.update(page)
+            if CURSOR not in response.headers:
+                break
+            query['$cursor'] = response.headers[CURSOR]
+        assert sorted(map(int, out)) == sorted(uids[::2])
+        response = await client.get('/', json={'$limit': 0})
+        assert response.status == 400
+        response = await client.get('/_count', json={'a/b': 1})
+        assert await response.json() == dict(count=10)
+        # the field names are quoted again for the shards
+        response = await client.get('/_group/a%2Fb')
+        assert await response.json() == [[0, 10], [1, 10]]
+        response = await client.get('/_distinct/a%2Fb')
+        assert await response.json() == [0, 1]
+
+    route(tmp_path, test)
+
+
+def test_changes(tmp_path):
+    async def test(client, servers):
+        response = await client.get('/_changes', params=dict(since='0,0'))
+        assert response.status == 400
+        for limit in ('0', '-1', 'x'):
+            response = await client.get('/_changes', params=dict(limit=limit))
+            assert response.status == 400
+        waiting = asyncio.ensure_future(client.get('/_changes'))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        uid = await create(client, dict(a=1))
+        out = await (await waiting).json()
+        assert out['changes'] == [[1, 'create', uid]]
+        last = out['last']
+        other = await create(client, dict(a=2))
+        response = await client.get('/_changes', params=dict(since=last))
+        assert (await response.json())['changes'] == [[1, 'create', other]]
+
+    route(tmp_path, test)
@@ -0,0 +1,177 @@
+"""Check the HTTP API of `deuspy.server` with a test client"""
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from deuspy.server import CURSOR
+from deuspy.server import NDJSON
+from deuspy.server import make_app
+
+
+def serve(path, test, **options):
+    """Run the coroutine function `test` with a client of a server of
+    the database at `path`"""
+    async def main():
+        async with TestClient(TestServer(make_app(str(path), **options))) as client:
+            await test(client)
+
+    asyncio.run(main())
+
+
+async def create(client, doc):
+    response = await client.post('/', json=doc)
+    assert response.status == 200
+    return await response.json()
+
+
+def test_pages(tmp_path):
+    async def test(client):
+        uids = [await create(client, dict(a=1, i=i)) for i in range(25)]
+        out = dict()
+        query = {'a': 1, '$limit': 10}
+        while True:
+            response = await client.get('/', json=query)
+            assert response.status == 200
+            out.update(await response.json())
+            if CURSOR not in response.headers:
+                break
+            query['$cursor'] = response.headers[CURSOR]
+        assert out == {str(uid): dict(a=1, i=i) for i, uid in enumerate(uids)}
+        for limit in (0, -1, 'x'):
+            response = await client.get('/', json={'$limit': limit})
+            assert response.status == 400
+        response = await client.get('/', headers={'Accept': NDJSON})
+        lines = (await response.text()).splitlines()
+        assert [json.loads(line)[0] for line in lines] == uids
+
+    serve(tmp_path, test)
+
+
+@pytest.mark.parametrize('format', ['binary', 'json'])
+def test_read(tmp_path, format):
+    async def test(client):
+        uid = await create(client, dict(title='deuspy', tags=['a']))
+        response = await client.get('/{}'.format(uid))
+        assert response.status == 200
+        assert response.content_type == 'application/json'
+        assert await response.json() == dict(title='deuspy', tags=['a'])
+        response = await client.post('/_mget', json=[uid, uid + 1])
+        assert await response.json() == {str(uid): dict(title='deuspy', tags=['a'])}
+        response = await client.get('/{}'.format(uid + 1))
+        assert response.status == 404
+
+    serve(tmp_path, test, format=format)
+
+
+def test_cached_reads(tmp_path):
+    async def test(client):
+        uid = await create(client, dict(a=1))
+        for _ in range(3):
+            response = await client.get('/{}'.format(uid))
+            assert await response.json() == dict(a=1)
+        await client.post('/{}'.format(uid), json=dict(a=2))
+        response = await client.get('/{}'.format(uid))
+        assert await response.json() == dict(a=2)
+        stats = client.server.app['deuspy'].cache_stats()
+        assert stats['hits'] == 2
+
+    serve(tmp_path, test, cache_entries=10)
+
+
+def test_bulk(tmp_path):
+    async def test(client):
+        lines = [json.dumps(dict(i=i)) for i in range(3)] + ['[]', json.dumps(dict(i=3))]
+        response = await client.post('/_bulk', data='\n'.join(lines) + '\n')
+        assert response.status == 200
+        results = [json.loads(line) for line in (await response.text()).splitlines()]
+        assert 'error' in results[3]
+        uids = results[:3] + results[4:]
+        response = await client.post('/_mget', json=uids)
+        assert await response.json() == {str(uid): dict(i=i) for i, uid in enumerate(uids)}
+
+    serve(tmp_path, test)
+
+
+def test_patch(tmp_path):
+    async def test(client):
+        uid = await create(client, dict(a=1, b=2, n=1))
+        response = await client.patch('/{}'.format(uid), json={
+            '$set': dict(a=3), '$unset': ['b'], '$inc': dict(n=1),
+        })
+        assert response.status == 200
+        assert await response.json() == dict(a=3, n=2)
+        response = await client.get('/', json=dict(a=3))
+        assert list(await response.json()) == [str(uid)]
+        response = await client.patch('/{}'.format(uid + 1), json={'$set': dict(a=1)})
+        assert response.status == 404
+        for body in ({'$push': dict(a=1)}, {'$inc': dict(a='x')}, [1]):
+            response = await client.patch('/{}'.format(uid), json=body)
+            assert response.status == 400
+        response = await client.get('/{}'.format(uid))
+        assert await response.json() == dict(a=3, n=2)
+
+    serve(tmp_path, test)
+
+
+def test_changes(tmp_path):
+    async def test(client):
+        first = await create(client, dict(a=1))
+        response = await client.get('/_changes')
+        assert await response.json() == dict(changes=[[1, 'create', first]], last=1)
+        # wait for the next change
+        waiting = asyncio.ensure_future(client.get('/_changes', params=dict(since='1')))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await client.delete('/{}'.format(first))
+        response = await waiting
+        assert await response.json() == dict(changes=[[2, 'delete', first]], last=2)
+        response = await client.get('/_changes', params=dict(since='2', timeout='0'))
+        assert await response.json() == dict(changes=[], last=2)
+        for limit in ('0', '-1', 'x'):
+            response = await client.get('/_changes', params=dict(limit=limit))
+            assert response.status == 400
+
+    serve(tmp_path, test)
+
+
+@pytest.mark.parametrize('cache_entries', [None, 10])
+def test_conditional_requests(tmp_path, cache_entries):
+    async def test(client):
+        uid = await create(client, dict(a=1))
+        url = '/{}'.format(uid)
+        response = await client.get(url)
+        etag = response.headers['ETag']
+        response = await client.get(url, headers={'If-None-Match': etag})
+        assert response.status == 304
+        response = await client.post(url, json=dict(a=2), headers={'If-Match': etag})
+        assert response.status == 200
+        # the document changed since `etag`
+        response = await client.get(url, headers={'If-None-Match': etag})
+        assert response.status == 200
+        assert response.headers['ETag'] != etag
+        headers = {'If-Match': etag}
+        assert (await client.post(url, json=dict(a=3), headers=headers)).status == 412
+        assert (await client.patch(url, json={'$set': dict(a=3)}, headers=headers)).status == 412
+        assert (await client.delete(url, headers=headers)).status == 412
+        assert (await client.delete(url, headers={'If-Match': 'nope'})).status == 400
+        assert await (await client.get(url)).json() == dict(a=2)
+
+    serve(tmp_path, test, cache_entries=cache_entries)
+
+
+def test_metrics(tmp_path):
+    async def test(client):
+        await create(client, dict(a=1))
+        await client.get('/_changes', params=dict(timeout='0'))
+        response = await client.get('/_metrics')
+        assert response.status == 200
+        text = await response.text()
+        assert 'deuspy_handler_seconds_count{handler="create"} 1' in text
+        assert 'deuspy_commit_operations_count{commit="batch"} 1' in text
+        # long-polls would skew the latency of the handlers
+        assert 'handler="changes"' not in text
+
+    serve(tmp_path, test)